@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb 14 20:12:00 2022
+
+@author: do6uk
+
+asyncio version of NativeAPI.WeConnect on a pooled aiohttp session (needs aiohttp).
+Login, tokens, OAuth scopes and home regions are handled by a NativeAPI.WeConnect
+instance in the default executor, only the requests are sent asynchronously.
+"""
+import asyncio
+import functools
+import logging
+import aiohttp
+from urllib.parse import urlparse
+from NativeAPI import WeConnect, UrlError, error_message
+from ratelimit import retry_delay
+
+logger = logging.getLogger('API')
+
+class AsyncWeConnect():
+    __accept_mbb = 'application/json, application/vnd.volkswagenag.com-error-v1+json, */*'
+
+    def __init__(self, api=None, limit=100, limit_per_host=20):
+        self.__api = api if api else WeConnect()
+        self.__limit = limit
+        self.__limit_per_host = limit_per_host
+        self.__session = None
+        self.__login_lock = asyncio.Lock()
+        self.__fal_urls = {}
+        self.__request_stats = {'throttled': 0, 'retried': 0}
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if (self.__session):
+            await self.__session.close()
+            self.__session = None
+
+    def __get_session(self):
+        if (not self.__session):
+            connector = aiohttp.TCPConnector(limit=self.__limit, limit_per_host=self.__limit_per_host)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def __run(self, func, *args, **kwargs):
+        # blocking parts of the sync client (login, token refresh, credential store, home region) run in the default executor
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def login(self):
+        async with self.__login_lock:
+            return await self.__run(self.__api.login)
+
+    async def __prepare_command(self, command, dashboard=None, scope=None, **kwargs):
+        # fresh tokens: headers are built on the loop, only login and refresh go to the executor
+        if (self.__api.tokens_fresh()):
+            return self.__api.command_url(command, dashboard), self.__api.command_headers(scope, **kwargs)
+        async with self.__login_lock:
+            logger.debug('Tokens expired or due. Checking in executor')
+            return await self.__run(self.__api.prepare_command, command, dashboard=dashboard, scope=scope, **kwargs)
+
+    async def __get_fal_url(self, vin):
+        if (vin not in self.__fal_urls):
+            self.__fal_urls[vin] = await self.__run(self.__api.get_fal_url, vin)
+        return self.__fal_urls[vin]
+
+    async def __command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None):
+        url, headers = await self.__prepare_command(command, dashboard=dashboard, scope=scope, accept=accept, content_type=content_type, secure_token=secure_token)
+        # same budget and retries as WeConnect.__get_url: GETs are retried on RETRY_STATUS, POSTs never
+        method = 'GET' if (post is None and data is None) else 'POST'
+        limiter = self.__api.rate_limiter()
+        attempt = 0
+        while True:
+            if (await limiter.acquire_async(urlparse(url).netloc)):
+                self.__request_stats['throttled'] += 1
+            async with self.__get_session().request(method, url, json=post, data=data, headers=headers) as r:
+                logger.info('Sent %s request to %s', method, url)
+                logger.info('Response with code: %d', r.status)
+                if (method == 'GET' and r.status in WeConnect.RETRY_STATUS and attempt < WeConnect.RETRIES):
+                    attempt += 1
+                    delay = retry_delay(attempt, r.headers.get('Retry-After'), WeConnect.RETRY_BASE, WeConnect.RETRY_MAX)
+                    logger.warning('Response with code %d, retrying in %.1fs (%d/%d)', r.status, delay, attempt, WeConnect.RETRIES)
+                    self.__request_stats['retried'] += 1
+                else:
+                    if r.status >= 400:
+                        try:
+                            e = await r.json(content_type=None)
+                        except ValueError:
+                            e = None
+                        raise UrlError(r.status, error_message(r.status, e), r)
+                    if ('json' in r.headers.get('Content-Type', '')):
+                        return await r.json()
+                    return await r.read()
+            await asyncio.sleep(delay)
+
+    def request_stats(self):
+        # requests of this client delayed by the shared rate limiter and retries after RETRY_STATUS
+        return dict(self.__request_stats)
+
+    def set_brand_country(self, brand='VW', country='DE'):
+        self.__api.set_brand_country(brand, country)
+
+    def version(self):
+        return self.__api.version()
+
+    async def get_personal_data(self):
+        return await self.__command('/personalData', dashboard=self.__api.get_profile_url())
+
+    async def get_real_car_data(self):
+        return await self.__command('/realCarData', dashboard=self.__api.get_profile_url())
+
+    async def get_mbb_status(self):
+        return await self.__command('/mbbStatusData', dashboard=self.__api.get_profile_url())
+
+    async def get_identity_data(self):
+        return await self.__command('/identityData', dashboard=self.__api.get_profile_url())
+
+    async def get_vehicles(self):
+        return await self.__command('/usermanagement/users/v1/{brand}/{country}/vehicles', dashboard=WeConnect.BASE_URL, scope='sc2:fal')
+
+    async def get_vehicle_data(self, vin):
+        __accept = 'application/vnd.vwg.mbb.vehicleDataDetail_v2_1_0+json, application/vnd.vwg.mbb.genericError_v1_0_2+json'
+        return await self.__command('/vehicleMgmt/vehicledata/v2/{brand}/{country}/vehicles/'+vin, dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=__accept)
+
+    async def get_users(self, vin):
+        # needs the id token of the sync client
+        return await self.__run(self.__api.get_users, vin)
+
+    async def get_fences(self, vin):
+        return await self.__command('/bs/geofencing/v1/{brand}/{country}/vehicles/'+vin+'/geofencingAlerts', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_fences_configuration(self):
+        return await self.__command('/bs/geofencing/v1/{brand}/{country}/geofencingConfiguration', dashboard=WeConnect.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_speed_alerts(self, vin):
+        return await self.__command('/bs/speedalert/v1/{brand}/{country}/vehicles/'+vin+'/speedAlerts', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_speed_alerts_configuration(self):
+        return await self.__command('/bs/speedalert/v1/{brand}/{country}/speedAlertConfiguration', dashboard=WeConnect.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_trip_data(self, vin, type='longTerm'):
+        # type: 'longTerm', 'cyclic', 'shortTerm'
+        return await self.__command('/bs/tripstatistics/v1/{brand}/{country}/vehicles/'+vin+'/tripdata/'+type+'?type=list', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_vsr(self, vin):
+        return await self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_departure_timer(self, vin):
+        return await self.__command('/bs/departuretimer/v1/{brand}/{country}/vehicles/'+vin+'/timer', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_climater(self, vin):
+        return await self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_position(self, vin):
+        return await self.__command('/bs/cf/v1/{brand}/{country}/vehicles/'+vin+'/position', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_destinations(self, vin):
+        return await self.__command('/destinationfeedservice/mydestinations/v1/{brand}/{country}/vehicles/'+vin+'/destinations', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_charger(self, vin):
+        return await self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_heating_status(self, vin):
+        return await self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_history(self, vin):
+        return await self.__command('/bs/dwap/v1/{brand}/{country}/vehicles/'+vin+'/history', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_roles_rights(self, vin):
+        # needs the business id of the sync client
+        return await self.__run(self.__api.get_roles_rights, vin)
+
+    async def get_fetched_role(self, vin):
+        return await self.__command('/rolesrights/permissions/v1/{brand}/{country}/vehicles/'+vin+'/fetched-role', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_vehicle_health_report(self, vin):
+        # DEPRECATED like the sync version, runs in the executor
+        return await self.__run(self.__api.get_vehicle_health_report, vin)
+
+    async def get_car_port_data(self, vin):
+        return await self.__command('/promoter/portfolio/v1/{brand}/{country}/vehicle/'+vin+'/carportdata', dashboard=await self.__get_fal_url(vin), accept=self.__accept_mbb, scope='sc2:fal')
+
+    async def request_status_update(self, vin):
+        return await self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests', dashboard=await self.__get_fal_url(vin), post={}, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def request_status(self, vin, reqId):
+        return await self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/jobstatus', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_vsr_request(self, vin, reqId):
+        return await self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/status', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def __flash_and_honk(self, vin, mode, lat, long, duration = 15):
+        data = {
+            'honkAndFlashRequest': {
+                'serviceOperationCode': mode,
+                'serviceDuration': duration,
+                'userPosition': {
+                    'latitude': lat,
+                    'longitude': long,
+                    }
+                }
+            }
+        return await self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash', dashboard=await self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def flash(self, vin, lat, long, duration = 15):
+        return await self.__flash_and_honk(vin, 'FLASH_ONLY', lat, long, duration)
+
+    async def honk(self, vin, lat, long, duration = 15):
+        return await self.__flash_and_honk(vin, 'HONK_AND_FLASH', lat, long, duration)
+
+    async def get_honk_and_flash_status(self, vin, rid):
+        return await self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash/'+str(rid)+'/status', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def get_honk_and_flash_configuration(self):
+        return await self.__command('/bs/rhf/v1/{brand}/{country}/configuration', dashboard=WeConnect.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def battery_charge(self, vin, action='off'):
+        data = {
+            'action': {
+                'type': 'start' if action.lower() == 'on' else 'stop'
+                }
+            }
+        return await self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger/actions', dashboard=await self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def __climater_action(self, vin, data):
+        return await self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=await self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
+
+    async def climatisation(self, vin, action='off'):
+        data = {
+            'action': {
+                'type': 'startClimatisation' if action.lower() == 'on' else 'stopClimatisation'
+                }
+            }
+        return await self.__climater_action(vin, data)
+
+    async def climatisation_temperature(self, vin, temperature=21.5):
+        dk = temperature*10+2731
+        data = {
+            'action': {
+                'type': 'setSettings',
+                'settings': {
+                    'targetTemperature': dk,
+                    'climatisationWithoutHVpower': True,
+                    'heaterSource': 'electric',
+                    }
+                }
+            }
+        return await self.__climater_action(vin, data)
+
+    async def window_melt(self, vin, action='off'):
+        data = {
+            'action': {
+                'type': 'startWindowHeating' if action.lower() == 'on' else 'stopWindowHeating'
+                }
+            }
+        return await self.__climater_action(vin, data)
+
+    async def __secure_command(self, vin, service, command, **kwargs):
+        # cache, S-PIN handshake and rejection policy are those of the sync client, the handshake runs in the executor
+        secure_token, cached = await self.__run(self.__api.get_secure_token, vin, service)
+        try:
+            return await self.__command(command, secure_token=secure_token, **kwargs)
+        except UrlError as e:
+            if (not self.__api.secure_token_rejected(vin, service, cached, e)):
+                raise
+            secure_token, cached = await self.__run(self.__api.get_secure_token, vin, service)
+            return await self.__command(command, secure_token=secure_token, **kwargs)
+
+    async def heating(self, vin, action='off'):
+        if (action == 'on'):
+            data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<performAction xmlns="http://audi.de/connect/rs">\n   <quickstart>\n      <active>true</active>\n   </quickstart>\n</performAction>'
+        else:
+            data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<performAction xmlns="http://audi.de/connect/rs">\n   <quickstop>\n      <active>false</active>\n   </quickstop>\n</performAction>'
+        return await self.__secure_command(vin, 'rheating_v1/operations/P_QSACT', '/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=WeConnect.BASE_URL, data=data, scope='sc2:fal', accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteStandheizung_v2_0_0+xml')
+
+    async def lock(self, vin, action='lock'):
+        if (action == 'unlock'):
+            data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>unlock</action>\n</rluAction>'
+        else:
+            data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>lock</action>\n</rluAction>'
+        return await self.__secure_command(vin, 'rlu_v1/operations/' + action.upper(), '/bs/rlu/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=WeConnect.BASE_URL, data=data, scope='sc2:fal', accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteLockUnlock_v1_0_0+xml')
+
+    def parse_vsr(self, j, typed=False):
+        return self.__api.parse_vsr(j, typed)
+
+    async def pso(self, vin):
+        return await self.__command('/bs/otv/v1/{brand}/{country}/vehicles/'+vin+'/configuration', dashboard=await self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
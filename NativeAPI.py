@@ -9,6 +9,11 @@ import _version
 import logging
 import credentials
 from vsr import VSR
+from cache import ResponseCache
+from ratelimit import RateLimiter, retry_delay
+from loginpage import find_form, find_idk, find_meta
+from credstore import CredentialStore
+from metrics import Metrics
 import re
 
 logging.basicConfig(format='[%(asctime)s] [%(name)s::%(levelname)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
@@ -29,8 +34,7 @@ class UrlError(VWError):
         super().__init__(message)
     pass
 
-import requests, pickle, hashlib, base64, os, random, time, json, xmltodict, re
-from bs4 import BeautifulSoup
+import requests, pickle, hashlib, base64, os, random, time, json, re, threading
 from urllib.parse import urlparse, unquote_plus
 
 def get_random_string(length=12,
@@ -51,6 +55,18 @@ def random_id():
 def base64URLEncode(s):
     return base64.urlsafe_b64encode(s).rstrip(b'=')
 
+def error_message(status_code, e):
+    if (e is None):
+        return "Error: status code {}".format(status_code)
+    msg = 'Error {}'.format(status_code)
+    if ('error' in e):
+        msg += ':'
+        if ('errorCode' in e['error']):
+            msg += ' [{}]'.format(e['error']['errorCode'])
+        if ('description' in e['error']):
+            msg += ' '+e['error']['description']
+    return msg
+
 def get_url_params(url):
     args = url.split('?')
     blocks = args[-1].split('#')
@@ -88,77 +104,118 @@ class WeConnect():
     __session = None
     __dashboard = None
     __edit_profile_url = None
-    SESSION_FILE = 'weconnectAPI.session'
+    CREDENTIAL_FILE = 'weconnectAPI.credentials'
+    SESSION_FILE = 'weconnectAPI.session' # former files, migrated to CREDENTIAL_FILE
     ACCESS_FILE = 'weconnectAPI.access'
+    HOMEREGION_FILE = 'weconnectAPI.homeregion'
+    HOMEREGION_TTL = 30*24*3600
     BASE_URL = 'https://msg.volkswagen.de/fs-car'
     TOKEN_URL = 'https://tokenrefreshservice.apps.emea.vwapps.io'
     PROFILE_URL = 'https://customer-profile.apps.emea.vwapps.io/v1/customers/{}'
     OAUTH_URL = 'https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/oauth2/v1/token'
     USER_URL = 'https://userinformationservice.apps.emea.vwapps.io/iaa'
     MAL_URL = 'https://mal-1a.prd.ece.vwg-connect.com/api'
+    IDENTITY_URL = 'https://identity.vwgroup.io'
+    REGISTER_URL = 'https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/register/v1'
     __tokens = None
-    __credentials = {}
+    __cache = None
     __x_client_id = None
-    __oauth = {}
     __accept_mbb = 'application/json, application/vnd.volkswagenag.com-error-v1+json, */*'
+    REFRESH_LEAD = 300 # seconds before expiry a token is refreshed in background
+    SECURE_TOKEN_TTL = 600 # seconds a security token of the S-PIN handshake is reused
+    RATE_LIMIT = (2, 10) # requests per second and burst for the account ...
+    HOST_RATE_LIMIT = (2, 10) # ... and for each host, most requests go to the home-region host, so not lower than the account
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    RETRIES = 3
+    RETRY_BASE = 1 # seconds, doubled for each retry
+    RETRY_MAX = 60
+    TIMEOUT = (5, 30) # connect and read timeout in seconds
+    POOL_DEFAULT = 10 # kept-alive connections per host ...
+    POOL_SIZES = { # ... and per URL prefix
+        'https://msg.volkswagen.de': 20,
+        'https://fal-': 10,
+        'https://mal-': 10,
+        'https://tokenrefreshservice.': 4,
+        'https://mbboauth-': 4,
+        'https://identity.vwgroup.io': 4,
+        }
     __brand = 'VW'
     __country = 'DE'
 
     def __get_url(self, url,get=None,post=None,json=None,cookies=None,headers=None):
-        if (post == None and json == None):
-            r = self.__session.get(url, params=get, headers=headers, cookies=cookies)
-        else:
-            r = self.__session.post(url, data=post, json=json, params=get, headers=headers, cookies=cookies)
-        logger.info('Sending %s request to %s', r.request.method, r.url)
-        logger.debug('Parameters: %s', r.request.url)
-        logger.debug('Headers: %s', r.request.headers)
-        logger.info('Response with code: %d', r.status_code)
-        logger.debug('Headers: %s', r.headers)
-        logger.debug('History: %s', r.history)
+        # GETs are retried on RETRY_STATUS, POSTs never: an action must not be sent twice
+        idempotent = (post == None and json == None)
+        # everything sent during a full login counts as login, also its token and OAuth requests
+        endpoint = 'login' if getattr(self.__local, 'login', False) else self.__metrics.endpoint('GET' if idempotent else 'POST', url)
+        attempt = 0
+        while True:
+            if (self.__limiter.acquire(urlparse(url).netloc)):
+                self.__count('throttled')
+            t = time.perf_counter()
+            try:
+                if (idempotent):
+                    r = self.__session.get(url, params=get, headers=headers, cookies=cookies, timeout=self.TIMEOUT)
+                else:
+                    r = self.__session.post(url, data=post, json=json, params=get, headers=headers, cookies=cookies, timeout=self.TIMEOUT)
+            except requests.exceptions.RequestException:
+                self.__metrics.observe(endpoint, time.perf_counter()-t, 'error')
+                raise
+            self.__metrics.observe(endpoint, time.perf_counter()-t, r.status_code, len(r.request.body or ''), len(r.content or ''))
+            logger.info('Sending %s request to %s', r.request.method, r.url)
+            logger.debug('Parameters: %s', r.request.url)
+            logger.debug('Headers: %s', r.request.headers)
+            logger.info('Response with code: %d', r.status_code)
+            logger.debug('Headers: %s', r.headers)
+            logger.debug('History: %s', r.history)
+            if (not idempotent or r.status_code not in self.RETRY_STATUS or attempt >= self.RETRIES):
+                break
+            attempt += 1
+            delay = retry_delay(attempt, r.headers.get('Retry-After'), self.RETRY_BASE, self.RETRY_MAX)
+            logger.warning('Response with code %d, retrying in %.1fs (%d/%d)', r.status_code, delay, attempt, self.RETRIES)
+            self.__count('retried')
+            time.sleep(delay)
         if r.status_code >= 400:
             try:
                 e = r.json()
-                msg = 'Error {}'.format(r.status_code)
                 logger.debug('Response error in JSON format')
-                if ('error' in e):
-                    msg += ':'
-                    if ('errorCode' in e['error']):
-                        msg += ' [{}]'.format(e['error']['errorCode'])
-                    if ('description' in e['error']):
-                        msg += ' '+e['error']['description']
             except ValueError:
                 logger.debug('Response error is not JSON format')
-                msg = "Error: status code {}".format(r.status_code)
-            raise UrlError(r.status_code, msg, r)
+                e = None
+            raise UrlError(r.status_code, error_message(r.status_code, e), r)
         #else:
         #    print(r.content.decode())
         return r
 
-    def __command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None):
-        if (not dashboard):
-            dashboard = self.__dashboard
-        if (not scope):
-            scope = self.__tokens
-        command = command.format(brand=self.__brand, country=self.__country)
-        logger.info('Preparing command: %s', command)
+    def prepare_command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None):
+        # checks the tokens and returns url and headers of a command without sending it
+        # scope is the name of an OAuth scope ('sc2:fal') or None for the identity kit tokens
+        url = self.command_url(command, dashboard)
+        logger.info('Preparing command: %s', url)
         if (post):
             logger.debug('JSON data: %s', post)
         if (data):
             logger.debug('POST data: %s', data)
-        logger.debug('Dashboard: %s', dashboard)
         if (accept):
             logger.debug('Accept: %s', accept)
         if (content_type):
             logger.debug('Content-tpye: %s', content_type)
         if (scope):
-            logger.debug('Scope: %s', scope['__name__'])
+            logger.debug('Scope: %s', scope)
         if (secure_token):
             logger.debug('Secure token: %s', secure_token)
         try:
             if (not self.__check_tokens()):
-                self.__force_login()
+                self.__login_once()
         except UrlError as e:
-            raise VWError('Aborting command {}: login failed ({})'.format(command,e.message))
+            raise VWError('Aborting command {}: login failed ({})'.format(url,e.message))
+        return url, self.command_headers(scope, accept, content_type, secure_token)
+
+    def command_url(self, command, dashboard=None):
+        return (dashboard if dashboard else self.__dashboard)+command.format(brand=self.__brand, country=self.__country)
+
+    def command_headers(self, scope=None, accept='application/json', content_type=None, secure_token=None):
+        # request headers with the current tokens, never checks or refreshes them (see tokens_fresh)
+        scope = self.__oauth[scope] if scope else self.__tokens
         headers = {
             'Authorization': 'Bearer '+scope['access_token'],
             'Accept': accept,
@@ -170,14 +227,89 @@ class WeConnect():
             headers['Content-Type'] = content_type
         if (secure_token):
             headers['X-MBBSecToken'] = secure_token
-        r = self.__get_url(dashboard+command, json=post, post=data, headers=headers)
+        return headers
+
+    def __command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None):
+        cache_key = cache_class = None
+        if (self.__cache):
+            url = self.command_url(command, dashboard)
+            if (post is None and data is None):
+                cache_class = self.__cache.endpoint_class(url)
+                if (cache_class):
+                    cache_key = (url, accept)
+                    jr = self.__cache.get(cache_key)
+                    if (jr is not None):
+                        return jr
+            else:
+                self.__cache.invalidate_url(url)
+        url, headers = self.prepare_command(command, post=post, data=data, dashboard=dashboard, accept=accept, content_type=content_type, scope=scope, secure_token=secure_token)
+        r = self.__get_url(url, json=post, post=data, headers=headers)
         if ('json' in r.headers['Content-Type']):
             jr = r.json()
+            if (cache_key):
+                self.__cache.put(cache_key, cache_class, jr)
             return jr
         return r
 
+    def __count(self, name):
+        with self.__stats_lock:
+            self.__request_stats[name] += 1
+
+    def request_stats(self):
+        # requests delayed by the rate limiter and retries after RETRY_STATUS
+        with self.__stats_lock:
+            return dict(self.__request_stats)
+
+    def rate_limiter(self):
+        # the request budget of this client, AsyncAPI.AsyncWeConnect takes its requests from it too
+        return self.__limiter
+
+    def request_metrics(self):
+        # latency, status codes and bytes per endpoint (vsr, charger, climater, position, action, token_refresh, secure_pin, ...)
+        return self.__metrics.snapshot()
+
+    def request_metrics_text(self):
+        return self.__metrics.prometheus()
+
+    def start_metrics_server(self, port=9120, host='127.0.0.1'):
+        # Prometheus endpoint http://host:port/metrics, host '' for all interfaces
+        return self.__metrics.start_http_server(port, host)
+
+    def enable_cache(self, ttls=None, maxsize=256):
+        # ttls: {'configuration': seconds, 'vehicle': seconds, 'vehicledata': seconds, 'profile': seconds}, 0 disables a class
+        self.__cache = ResponseCache(ttls, maxsize)
+
+    def disable_cache(self):
+        self.__cache = None
+
+    def invalidate_cache(self, vin=None):
+        if (self.__cache):
+            self.__cache.invalidate(vin)
+
+    def cache_stats(self):
+        return self.__cache.stats() if self.__cache else None
+
     def __init__(self):
         self.__session = requests.Session()
+        # per instance: two clients with different credential files never share tokens
+        self.__credentials = {}
+        self.__oauth = {}
+        self.__login_timings = {}
+        # one lock per token: concurrent refreshes of the same token collapse into one
+        self.__refresh_locks = {name: threading.Lock() for name in ('login', 'kit', 'sc2:fal', 't2_v:cubic')}
+        self.__refreshing = set()
+        self.__refreshing_lock = threading.Lock()
+        self.__refresher = None
+        self.__homeregions = {}
+        # one lock per vin: lookups of different vehicles run in parallel
+        self.__homeregion_locks = {}
+        self.__homeregion_lock = threading.Lock()
+        self.__secure_tokens = {}
+        self.__metrics = Metrics()
+        self.__local = threading.local()
+        self.__limiter = RateLimiter(*self.RATE_LIMIT, *self.HOST_RATE_LIMIT)
+        self.__request_stats = {'throttled': 0, 'retried': 0}
+        self.__stats_lock = threading.Lock()
         self.__credentials['user'] = credentials.username
         self.__credentials['password'] = credentials.password
         self.__credentials['spin'] = None
@@ -195,22 +327,78 @@ class WeConnect():
             else:
                 raise VWError('Wrong S-PIN format: must be 4-digits')
 
+        self.__store = CredentialStore(WeConnect.CREDENTIAL_FILE)
+        d = self.__store.read()
+        if (d):
+            self.__adopt_access(d)
+        else:
+            logger.warning('Credential store not found')
+            self.__migrate_access()
+        self.__load_homeregions()
+        self.__mount_adapters()
+
+    def __mount_adapters(self):
+        self.__session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.POOL_DEFAULT))
+        for prefix, size in self.POOL_SIZES.items():
+            self.__session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=size))
+        self.__session.mount("carnet://", CarNetAdapter())
+
+    def prewarm(self):
+        # opens one connection to each known host, so the first requests skip TCP and TLS handshakes
+        urls = [self.BASE_URL, self.TOKEN_URL, self.OAUTH_URL, self.MAL_URL, self.IDENTITY_URL]
+        urls += [hr[k] for hr in self.__homeregions.values() for k in ('fal', 'mal')]
+        hosts = {}
+        for url in urls:
+            upr = urlparse(url)
+            hosts[upr.netloc] = upr.scheme+'://'+upr.netloc
+        warmed = 0
+        for host in hosts.values():
+            try:
+                # through the session, so the connection lands in the pool later requests take it from
+                self.__session.head(host+'/', allow_redirects=False, timeout=self.TIMEOUT)
+                warmed += 1
+            except Exception as e:
+                logger.info('Prewarming %s failed: %s', host, e)
+        logger.debug('Prewarmed connections to %d of %d hosts', warmed, len(hosts))
+        return warmed
+
+    def connection_stats(self):
+        # opened connections and sent requests per host, reuse is the share of requests on a kept-alive connection
+        hosts = {}
+        for adapter in set(self.__session.adapters.values()):
+            if (not isinstance(adapter, requests.adapters.HTTPAdapter) or isinstance(adapter, CarNetAdapter)):
+                continue
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if (pool is None):
+                    continue
+                h = hosts.setdefault(pool.host, {'connections': 0, 'requests': 0})
+                h['connections'] += pool.num_connections
+                h['requests'] += pool.num_requests
+        connections = sum(h['connections'] for h in hosts.values())
+        requests_sent = sum(h['requests'] for h in hosts.values())
+        return {'hosts': hosts, 'connections': connections, 'requests': requests_sent, 'reuse': 1-connections/requests_sent if requests_sent else None}
+
+    def __load_homeregions(self):
         try:
-            with open(WeConnect.SESSION_FILE, 'rb') as f:
-                self.__session.cookies.update(pickle.load(f))
-        except FileNotFoundError:
-            logger.warning('Session file not found')
-        try:
-            with open(WeConnect.ACCESS_FILE, 'rb') as f:
+            with open(WeConnect.HOMEREGION_FILE, 'r') as f:
                 d = json.load(f)
-                self.__identities = d['identities']
-                self.__identity_kit = d['identity_kit']
-                self.__tokens = d['tokens']
-                self.__x_client_id = d['x-client-id']
-                self.__oauth = d['oauth']
-        except FileNotFoundError:
-            logger.warning('Access file not found')
-        self.__session.mount("carnet://", CarNetAdapter())
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            logger.info('Home region file not found')
+            return
+        now = time.time()
+        self.__homeregions = {vin: hr for vin, hr in d.items() if hr['timestamp']+self.HOMEREGION_TTL > now}
+        logger.debug('Loaded home regions of %d vehicles', len(self.__homeregions))
+
+    def __save_homeregions(self):
+        # temporary file renamed over the old one under the store lock, like the credential store
+        with self.__store.locked():
+            tmp = WeConnect.HOMEREGION_FILE+'.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(dict(self.__homeregions), f)
+            os.replace(tmp, WeConnect.HOMEREGION_FILE)
+        logger.info('Saving home regions to file')
 
     def __refresh_oauth_scope(self, scope):
         data = {
@@ -225,31 +413,82 @@ class WeConnect():
         self.__oauth[scope] = jr
         self.__oauth[scope]['timestamp'] = time.time()
         self.__oauth[scope]['__name__'] = 'OAuth '+scope
+        if (not getattr(self.__local, 'login', False)):
+            self.__metrics.token_refreshed(scope)
         self.__save_access()
 
+    def __refresh_kit_tokens(self):
+        r = self.__get_url(self.TOKEN_URL+'/refreshTokens', post={'refresh_token': self.__tokens['refresh_token']})
+        self.__tokens = r.json()
+        self.__tokens['timestamp'] = time.time()
+        self.__tokens['__name__'] = 'Token'
+        self.__metrics.token_refreshed('kit')
+        self.__save_access()
+
+    def __get_token(self, name):
+        return self.__tokens if name == 'kit' else self.__oauth.get(name)
+
+    def __expires_in(self, token):
+        return token['timestamp']+token['expires_in']-time.time()
+
+    def __needs_refresh(self, token):
+        return self.__expires_in(token) < min(self.REFRESH_LEAD, token['expires_in']/4)
+
+    def __refresh_token(self, name):
+        # single-flight: callers arriving during a refresh wait for it and reuse its result,
+        # the store lock does the same for other processes
+        with self.__refresh_locks[name], self.__store.locked():
+            self.__sync_access()
+            token = self.__get_token(name)
+            if (token and not self.__needs_refresh(token)):
+                logger.debug('%s refreshed meanwhile', name)
+                return
+            if (name == 'kit'):
+                self.__refresh_kit_tokens()
+            else:
+                self.__refresh_oauth_scope(name)
+
+    def __refresh_background(self, name):
+        with self.__refreshing_lock:
+            if (name in self.__refreshing):
+                return
+            self.__refreshing.add(name)
+        logger.debug('Refreshing %s in background', name)
+        threading.Thread(target=self.__background_refresh, args=(name,), name='refresh-'+name, daemon=True).start()
+
+    def __background_refresh(self, name):
+        try:
+            self.__refresh_token(name)
+        except Exception as e:
+            logger.warning('Background refresh of %s failed: %s', name, e)
+        finally:
+            with self.__refreshing_lock:
+                self.__refreshing.discard(name)
+
     def __check_kit_tokens(self):
         if (self.__tokens):
             if (self.__tokens['timestamp']+self.__tokens['expires_in'] > time.time()):
                 logger.debug('Tokens still valid')
+                if (self.__needs_refresh(self.__tokens)):
+                    self.__refresh_background('kit')
                 return True
             logger.debug('Token expired. Refreshing tokens')
-            r = self.__get_url(self.TOKEN_URL+'/refreshTokens', post={'refresh_token': self.__tokens['refresh_token']})
-            self.__tokens = r.json()
-            self.__tokens['timestamp'] = time.time()
-            self.__tokens['__name__'] = 'Token'
-            self.__save_access()
+            self.__refresh_token('kit')
             return True
         logger.debug('Token checking failed')
         return False
 
     def __check_oauth_scope(self, scope):
         if (scope in self.__oauth and self.__oauth[scope]):
+            refreshable = 'refresh_token' in self.__oauth[scope]
             if (self.__oauth[scope]['timestamp']+self.__oauth[scope]['expires_in'] > time.time()):
                 logger.debug('OAuth %s still valid', scope)
+                if (refreshable and self.__needs_refresh(self.__oauth[scope])):
+                    self.__refresh_background(scope)
                 return True
             logger.debug('OAUth %s expired. Refreshing', scope)
-            if (scope in self.__oauth and 'refresh_token' in self.__oauth[scope]):
-                self.__refresh_oauth_scope(scope)
+            if (refreshable):
+                self.__refresh_token(scope)
                 return True
             logger.error('OAUTH {} not present. Cannot refresh'.format(scope))
         logger.debug('OAuth [%s] checking failed', scope)
@@ -260,27 +499,146 @@ class WeConnect():
 
     def __check_tokens(self):
         logger.debug('Checking tokens')
+        self.__sync_access()
         return self.__check_kit_tokens() and self.__check_oauth_tokens()
 
+    def refresh_tokens(self):
+        # refreshes all tokens close to expiry, called by the token refresher
+        for name in ('kit', 'sc2:fal', 't2_v:cubic'):
+            token = self.__get_token(name)
+            if (token and self.__needs_refresh(token) and (name == 'kit' or 'refresh_token' in token)):
+                self.__refresh_token(name)
+
+    def start_token_refresher(self, interval=60):
+        # background thread keeping the tokens fresh, so commands do not wait for a refresh
+        if (self.__refresher):
+            return
+        self.__refresher_stop = threading.Event()
+        self.__refresher = threading.Thread(target=self.__token_refresher, args=(interval,), name='token-refresher', daemon=True)
+        self.__refresher.start()
+
+    def stop_token_refresher(self):
+        if (self.__refresher):
+            self.__refresher_stop.set()
+            self.__refresher = None
+
+    def __token_refresher(self, interval):
+        logger.info('Token refresher started')
+        while (not self.__refresher_stop.wait(interval)):
+            try:
+                self.refresh_tokens()
+            except Exception as e:
+                logger.warning('Token refresher failed: %s', e)
+        logger.info('Token refresher stopped')
+
+    def tokens_valid(self):
+        # True if all tokens are valid, never refreshes
+        now = time.time()
+        if (not self.__tokens or self.__tokens['timestamp']+self.__tokens['expires_in'] <= now):
+            return False
+        for scope in ('sc2:fal', 't2_v:cubic'):
+            if (not self.__oauth.get(scope) or self.__oauth[scope]['timestamp']+self.__oauth[scope]['expires_in'] <= now):
+                return False
+        return True
+
+    def tokens_fresh(self):
+        # True if all tokens are valid and none is due for a refresh, so command_headers can be used without prepare_command
+        if (not self.tokens_valid()):
+            return False
+        for name in ('kit', 'sc2:fal', 't2_v:cubic'):
+            token = self.__get_token(name)
+            if (self.__needs_refresh(token) and (name == 'kit' or 'refresh_token' in token)):
+                return False
+        return True
+
+    def __migrate_access(self):
+        # takes cookies and tokens of the former session and access files
+        try:
+            with open(WeConnect.SESSION_FILE, 'rb') as f:
+                self.__session.cookies.update(pickle.load(f))
+        except FileNotFoundError:
+            logger.warning('Session file not found')
+        try:
+            with open(WeConnect.ACCESS_FILE, 'rb') as f:
+                d = json.load(f)
+                self.__identities = d['identities']
+                self.__identity_kit = d['identity_kit']
+                self.__tokens = d['tokens']
+                self.__x_client_id = d['x-client-id']
+                self.__oauth = d['oauth']
+        except FileNotFoundError:
+            logger.warning('Access file not found')
+            return
+        logger.info('Migrating session and access file to credential store')
+        self.__save_access()
+
+    def __is_newer(self, token, than):
+        return token is not None and (than is None or token['timestamp'] > than['timestamp'])
+
+    def __adopt_access(self, d):
+        # takes tokens of the store that are newer than ours, e.g. refreshed by another process
+        if (self.__is_newer(d['tokens'], self.__tokens)):
+            logger.debug('Adopting tokens of credential store')
+            self.__identities = d['identities']
+            self.__identity_kit = d['identity_kit']
+            self.__tokens = d['tokens']
+            self.__x_client_id = d['x-client-id']
+            for c in d.get('cookies', []):
+                self.__session.cookies.set_cookie(requests.cookies.create_cookie(**c))
+        for scope, token in d['oauth'].items():
+            if (self.__is_newer(token, self.__oauth.get(scope))):
+                logger.debug('Adopting OAuth %s of credential store', scope)
+                self.__oauth[scope] = token
+
+    def __sync_access(self):
+        # cheap check (one stat) for tokens written by another process
+        if (self.__store.changed()):
+            d = self.__store.read()
+            if (d):
+                self.__adopt_access(d)
+
     def __save_access(self):
-        t = {}
-        t['identities'] = self.__identities
-        t['identity_kit'] = self.__identity_kit
-        t['tokens'] = self.__tokens
-        t['x-client-id'] = self.__x_client_id
-        t['oauth'] = self.__oauth
-        with open(WeConnect.ACCESS_FILE, 'w') as f:
-            json.dump(t, f)
-        logger.info('Saving access to file')
+        with self.__store.locked():
+            d = self.__store.read()
+            if (d):
+                self.__adopt_access(d)
+            t = {}
+            t['identities'] = self.__identities
+            t['identity_kit'] = self.__identity_kit
+            t['tokens'] = self.__tokens
+            t['x-client-id'] = self.__x_client_id
+            t['oauth'] = self.__oauth
+            t['cookies'] = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires, 'secure': c.secure, 'rest': c._rest} for c in self.__session.cookies]
+            self.__store.write(t)
+        logger.info('Saving access to credential store')
 
     def login(self):
         logger.info('logger')
         if (not self.__check_tokens()):
-            return self.__force_login()
+            return self.__login_once()
         return True
 
+    def __login_once(self):
+        # only one thread (and process) logs in, the others wait and use its tokens
+        with self.__refresh_locks['login'], self.__store.locked():
+            self.__sync_access()
+            if (self.tokens_valid()):
+                return True
+            self.__local.login = True
+            try:
+                return self.__force_login()
+            finally:
+                self.__local.login = False
+
     def __force_login(self):
             logger.warning('Forcing login')
+            timings = {}
+            t = time.perf_counter()
+            def step(name):
+                nonlocal t
+                now = time.perf_counter()
+                timings[name] = now - t
+                t = now
             code_verifier = base64URLEncode(os.urandom(32))
             if len(code_verifier) < 43:
                 raise ValueError("Verifier too short. n_bytes must be > 30.")
@@ -300,64 +658,55 @@ class WeConnect():
                 }
             logger.info('Attempting to login')
             logger.debug('Login parameters: %s', login_para)
-            r = self.__get_url('https://identity.vwgroup.io/oidc/v1/authorize', get=login_para)
-            soup = BeautifulSoup(r.text, 'html.parser')
-            form = soup.find('form', {'id': 'emailPasswordForm'})
+            r = self.__get_url(self.IDENTITY_URL+'/oidc/v1/authorize', get=login_para)
+            form = find_form(r.text, 'emailPasswordForm')
             if (not form):
                 raise VWError('Login form not found. Cannot continue')
-            if (not form.has_attr('action')):
+            attrs, post = form
+            if ('action' not in attrs):
                 raise VWError('action not found in login email form. Cannot continue')
-            form_url = form['action']
+            form_url = attrs['action']
             logger.info('Found email login url: %s', form_url)
-            hiddn = form.find_all('input', {'type': 'hidden'})
-            post = {}
-            for h in hiddn:
-                post[h['name']] = h['value']
             post['email'] = self.__credentials['user']
+            step('authorize')
 
             upr = urlparse(r.url)
             r = self.__get_url(upr.scheme+'://'+upr.netloc+form_url, post=post)
 
-            soup = BeautifulSoup(r.text, 'html.parser')
-            scripts = soup.find_all('script')
-            for script in scripts:
-                if script.string and 'window._IDK' in script.string:
-                    try:
-                        idk_txt = '{'+re.search(r'\{(.*)\}',script.string,re.M|re.S).group(1)+'}'
-                        idk_txt = re.sub(r'([\{\s,])(\w+)(:)', r'\1"\2"\3', idk_txt.replace('\'','"'))
-                        idk = json.loads(idk_txt)
-                        break
-                    except json.decoder.JSONDecodeError:
-                        raise VWError('Cannot find IDK credentials')
+            try:
+                idk = find_idk(r.text)
+            except json.decoder.JSONDecodeError:
+                idk = None
+            if (not idk):
+                raise VWError('Cannot find IDK credentials')
+            step('email')
 
             post['hmac'] = idk['templateModel']['hmac']
             post['password'] = self.__credentials['password']
 
             upr = urlparse(r.url)
             r = self.__get_url(upr.scheme+'://'+upr.netloc+form_url.replace(idk['templateModel']['identifierUrl'],idk['templateModel']['postAction']), post=post)
+            step('password')
             if ('carnet://' not in r.url):
                 logger.info('No carnet scheme found in response.')
-                soup = BeautifulSoup(r.text, 'html.parser')
-                metakits = soup.find_all("meta", {'name':'identitykit'})
+                metakits = find_meta(r.text, 'identitykit')
 
                 for metakit in metakits:
-                    if (metakit['content'] == 'termsAndConditions'): #updated terms and conditions?
+                    if (metakit == 'termsAndConditions'): #updated terms and conditions?
                         logger.debug('Meta identitykit is termsandconditions')
-                        form = soup.find('form', {'id': 'emailPasswordForm'})
+                        form = find_form(r.text, 'emailPasswordForm')
                         if (form):
-                            if (not form.has_attr('action')):
+                            attrs, post = form
+                            if ('action' not in attrs):
                                 raise VWError('action not found in terms and conditions form. Cannot continue')
-                            form_url = form['action']
+                            form_url = attrs['action']
                             logger.info('Found terms and conditions url: %s', form_url)
-                            hiddn = form.find_all('input', {'type': 'hidden'})
-                            post = {}
-                            for h in hiddn:
-                                post[h['name']] = h['value']
                             upr = urlparse(r.url)
                             r = self.__get_url(upr.scheme+'://'+upr.netloc+form_url, post=post)
                             logger.info('Successfully accepted updated terms and conditions')
+                            step('terms')
                         break
-                    elif (metakit['content'] == 'loginAuthenticate'):
+                    elif (metakit == 'loginAuthenticate'):
                         logger.warn('Meta identitykit is loginAuthenticate')
                         if ('error' in r.url):
                             raise VWError(r.url.split('error=')[1])
@@ -375,11 +724,12 @@ class WeConnect():
                 'id_token': self.__identity_kit['id_token'],
                 }
             logger.info('Requesting Tokens')
-            r = self.__get_url('https://tokenrefreshservice.apps.emea.vwapps.io/exchangeAuthCode', post=data)
+            r = self.__get_url(self.TOKEN_URL+'/exchangeAuthCode', post=data)
             self.__tokens = r.json()
             self.__tokens['timestamp'] = time.time()
             self.__tokens ['__name__'] = 'Token'
             logger.info('Received Tokens')
+            step('tokens')
             if (not self.__x_client_id):
                 logger.warning('X-client-id not found. Requesting a new one')
                 data = {
@@ -390,10 +740,11 @@ class WeConnect():
                     "client_name": "iPhone",
                     "platform": "iOS"
                 }
-                r = self.__get_url('https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/register/v1', json=data)
+                r = self.__get_url(self.REGISTER_URL, json=data)
                 self.__x_client_id = r.json()['client_id']
                 logger.info('Received X-client-id')
                 logger.debug('X-client-id = %s', self.__x_client_id)
+                step('client_id')
             logger.info('Requesting OAuth [fal]')
             data = {
                 'grant_type': 'id_token',
@@ -408,39 +759,81 @@ class WeConnect():
             self.__oauth['sc2:fal']['timestamp'] = time.time()
             self.__oauth['sc2:fal']['__name__'] = 'OAuth sc2:fal'
             logger.debug('OAuth [fal] timestamp = %s', time.time())
+            step('oauth_fal')
             logger.info('Requesting OAuth [cubic]')
             self.__refresh_oauth_scope('t2_v:cubic')
             logger.debug('Received OAuth [cubic]')
-            with open(WeConnect.SESSION_FILE, 'wb') as f:
-                pickle.dump(self.__session.cookies, f)
+            step('oauth_cubic')
+            self.__save_access()
             logger.debug('Saving session')
             logger.info('Requesting personal data')
-            r = self.get_personal_data()
+            # without the token check of __command: it would enter __login_once again and wait for its own lock
+            r = self.__get_url(self.__identities['profile_url']+'/personalData', headers=self.command_headers()).json()
             self.__identities['business_id'] = r['businessIdentifierValue']
             logger.info('Received business identity')
             logger.debug('Bussiness identity = %s', r['businessIdentifierValue'])
             self.__save_access()
+            step('personal_data')
+            self.__login_timings = timings
+            logger.info('Login took %.2fs: %s', sum(timings.values()), ', '.join('{} {:.2f}s'.format(k, v) for k, v in timings.items()))
+
+    def login_timings(self):
+        # seconds per step of the last full login
+        return dict(self.__login_timings)
 
     def __get_homeregion(self, vin):
-        r = self.__command('/cs/vds/v1/vehicles/'+vin+'/homeRegion', dashboard=self.MAL_URL, scope=self.__oauth['sc2:fal'])
-        self.__identities['mal3'] = r['homeRegion']['baseUri']['content']
-        if ('mal-1a' in self.__identities['mal3']):
-            self.__identities['fal3'] = self.BASE_URL
-        else:
-            upr = urlparse(self.__identities['mal3'])
-            self.__identities['fal3'] = upr.scheme+'://'+upr.netloc.replace('mal','fal')+'/fs-car'
-        logger.debug('fal3 URL = %s', self.__identities['fal3'])
-        logger.info('Received fal/mal Uri')
+        # home region (fal/mal hosts) per vin, kept in HOMEREGION_FILE for HOMEREGION_TTL seconds
+        hr = self.__homeregions.get(vin)
+        if (hr and hr['timestamp']+self.HOMEREGION_TTL > time.time()):
+            return hr
+        with self.__homeregion_lock:
+            lock = self.__homeregion_locks.setdefault(vin, threading.Lock())
+        with lock:
+            hr = self.__homeregions.get(vin)
+            if (hr and hr['timestamp']+self.HOMEREGION_TTL > time.time()):
+                return hr
+            r = self.__command('/cs/vds/v1/vehicles/'+vin+'/homeRegion', dashboard=self.MAL_URL, scope='sc2:fal')
+            hr = {'mal': r['homeRegion']['baseUri']['content'], 'timestamp': time.time()}
+            if ('mal-1a' in hr['mal']):
+                hr['fal'] = self.BASE_URL
+            else:
+                upr = urlparse(hr['mal'])
+                hr['fal'] = upr.scheme+'://'+upr.netloc.replace('mal','fal')+'/fs-car'
+            logger.debug('fal URL of %s = %s', vin, hr['fal'])
+            logger.info('Received fal/mal Uri')
+            self.__homeregions[vin] = hr
+            self.__save_homeregions()
+            return hr
 
     def __get_fal_url(self, vin):
-        if ('fal3' not in self.__identities):
-            self.__get_homeregion(vin)
-        return self.__identities['fal3']
+        return self.__get_homeregion(vin)['fal']
 
     def __get_mal_url(self, vin):
-        if ('mal3' not in self.__identities):
-            self.__get_homeregion(vin)
-        return self.__identities['mal3']
+        return self.__get_homeregion(vin)['mal']
+
+    def get_fal_url(self, vin):
+        return self.__get_fal_url(vin)
+
+    def get_profile_url(self):
+        return self.__identities['profile_url']
+
+    @classmethod
+    def set_backend(cls, url):
+        # points all hosts to one server, e.g. mockbackend.py; call before creating a WeConnect
+        cls.BASE_URL = url+'/fs-car'
+        cls.TOKEN_URL = url
+        cls.PROFILE_URL = url+'/v1/customers/{}'
+        cls.OAUTH_URL = url+'/mbbcoauth/mobile/oauth2/v1/token'
+        cls.REGISTER_URL = url+'/mbbcoauth/mobile/register/v1'
+        cls.USER_URL = url+'/iaa'
+        cls.MAL_URL = url+'/api'
+        cls.IDENTITY_URL = url
+        # own credential and home region files, tokens of the real backend are never sent to it
+        tag = re.sub(r'\W+', '_', urlparse(url).netloc)
+        for k in ('CREDENTIAL_FILE', 'SESSION_FILE', 'ACCESS_FILE', 'HOMEREGION_FILE'):
+            root, ext = os.path.splitext(getattr(cls, k))
+            setattr(cls, k, root+'.'+tag+ext)
+        logger.warning('Using backend %s with credential store %s', url, cls.CREDENTIAL_FILE)
 
     def set_brand_country(self, brand='VW', country='DE'):
         self.__brand = brand
@@ -469,12 +862,12 @@ class WeConnect():
         return r
 
     def get_vehicles(self):
-        r = self.__command('/usermanagement/users/v1/{brand}/{country}/vehicles', dashboard=self.BASE_URL, scope=self.__oauth['sc2:fal'])
+        r = self.__command('/usermanagement/users/v1/{brand}/{country}/vehicles', dashboard=self.BASE_URL, scope='sc2:fal')
         return r
 
     def get_vehicle_data(self, vin):
         __accept = 'application/vnd.vwg.mbb.vehicleDataDetail_v2_1_0+json, application/vnd.vwg.mbb.genericError_v1_0_2+json'
-        r = self.__command('/vehicleMgmt/vehicledata/v2/{brand}/{country}/vehicles/'+vin, dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=__accept)
+        r = self.__command('/vehicleMgmt/vehicledata/v2/{brand}/{country}/vehicles/'+vin, dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=__accept)
         return r
 
     def get_users(self, vin):
@@ -482,71 +875,72 @@ class WeConnect():
         return r
 
     def get_fences(self, vin):
-        r = self.__command('/bs/geofencing/v1/{brand}/{country}/vehicles/'+vin+'/geofencingAlerts', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/geofencing/v1/{brand}/{country}/vehicles/'+vin+'/geofencingAlerts', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_fences_configuration(self):
-        r = self.__command('/bs/geofencing/v1/{brand}/{country}/geofencingConfiguration', dashboard=self.BASE_URL, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/geofencing/v1/{brand}/{country}/geofencingConfiguration', dashboard=self.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_speed_alerts(self, vin):
-        r = self.__command('/bs/speedalert/v1/{brand}/{country}/vehicles/'+vin+'/speedAlerts', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/speedalert/v1/{brand}/{country}/vehicles/'+vin+'/speedAlerts', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_speed_alerts_configuration(self):
-        r = self.__command('/bs/speedalert/v1/{brand}/{country}/speedAlertConfiguration', dashboard=self.BASE_URL, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/speedalert/v1/{brand}/{country}/speedAlertConfiguration', dashboard=self.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_trip_data(self, vin, type='longTerm'):
         # type: 'longTerm', 'cyclic', 'shortTerm'
-        r = self.__command('/bs/tripstatistics/v1/{brand}/{country}/vehicles/'+vin+'/tripdata/'+type+'?type=list', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/tripstatistics/v1/{brand}/{country}/vehicles/'+vin+'/tripdata/'+type+'?type=list', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_vsr(self, vin):
-        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_departure_timer(self, vin):
-        r = self.__command('/bs/departuretimer/v1/{brand}/{country}/vehicles/'+vin+'/timer', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/departuretimer/v1/{brand}/{country}/vehicles/'+vin+'/timer', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_climater(self, vin):
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_position(self, vin):
-        r = self.__command('/bs/cf/v1/{brand}/{country}/vehicles/'+vin+'/position', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/cf/v1/{brand}/{country}/vehicles/'+vin+'/position', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_destinations(self, vin):
-        r = self.__command('/destinationfeedservice/mydestinations/v1/{brand}/{country}/vehicles/'+vin+'/destinations', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/destinationfeedservice/mydestinations/v1/{brand}/{country}/vehicles/'+vin+'/destinations', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_charger(self, vin):
-        r = self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_heating_status(self, vin):
-        r = self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_history(self, vin):
-        r = self.__command('/bs/dwap/v1/{brand}/{country}/vehicles/'+vin+'/history', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/dwap/v1/{brand}/{country}/vehicles/'+vin+'/history', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_roles_rights(self, vin):
-        r = self.__command('/rolesrights/operationlist/v3/vehicles/'+vin+'/users/'+self.__identities['business_id'], dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/rolesrights/operationlist/v3/vehicles/'+vin+'/users/'+self.__identities['business_id'], dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_fetched_role(self, vin):
-        r = self.__command('/rolesrights/permissions/v1/{brand}/{country}/vehicles/'+vin+'/fetched-role', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/rolesrights/permissions/v1/{brand}/{country}/vehicles/'+vin+'/fetched-role', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_vehicle_health_report(self, vin):
         # DEPRECATED: this method is not reliable. It queries to far away GW sometimes it returns e504. The information returned is equivlent to get_vsr()
         # https://blog.vensis.pl/2019/11/vw-hacking/
         __accept = 'application/vnd.vwg.mbb.sharedTelemetricReport_v1_0_0+xml, application/vnd.vwg.mbb.genericError_v1_1_1+xml, */*'
-        r = self.__command('/vehiclehealthreport/myreports/v1/{brand}/{country}/vehicles/'+vin+'/users/'+self.__identities['business_id']+'/vehicleHealthReports/history', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=__accept)
+        r = self.__command('/vehiclehealthreport/myreports/v1/{brand}/{country}/vehicles/'+vin+'/users/'+self.__identities['business_id']+'/vehicleHealthReports/history', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=__accept)
+        import xmltodict
         namespaces = {
             'http://www.vw.com/mbb/service_TelemetricSharedService_MBB': None,
             'http://xmldefs.volkswagenag.com/DD/MaintenanceEvent/V1': None,
@@ -556,19 +950,19 @@ class WeConnect():
 
     def get_car_port_data(self, vin):
         # It seems disabled. It returns e403 Forbidden
-        r = self.__command('/promoter/portfolio/v1/{brand}/{country}/vehicle/'+vin+'/carportdata', dashboard=self.__get_fal_url(vin), accept=self.__accept_mbb, scope=self.__oauth['sc2:fal'])
+        r = self.__command('/promoter/portfolio/v1/{brand}/{country}/vehicle/'+vin+'/carportdata', dashboard=self.__get_fal_url(vin), accept=self.__accept_mbb, scope='sc2:fal')
         return r
 
     def request_status_update(self, vin):
-        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests', dashboard=self.__get_fal_url(vin), post={}, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests', dashboard=self.__get_fal_url(vin), post={}, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def request_status(self, vin, reqId):
-        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/jobstatus', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/jobstatus', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_vsr_request(self, vin, reqId):
-        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/status', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/requests/'+reqId+'/status', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def __flash_and_honk(self, vin, mode, lat, long, duration = 15):
@@ -582,7 +976,7 @@ class WeConnect():
                     }
                 }
             }
-        r = self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash', dashboard=self.__get_fal_url(vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash', dashboard=self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def flash(self, vin, lat, long, duration = 15):
@@ -592,11 +986,11 @@ class WeConnect():
         return self.__flash_and_honk(vin, 'HONK_AND_FLASH', lat, long, duration)
 
     def get_honk_and_flash_status(self, vin, rid):
-        r = self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash/'+str(rid)+'/status', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/rhf/v1/{brand}/{country}/vehicles/'+vin+'/honkAndFlash/'+str(rid)+'/status', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def get_honk_and_flash_configuration(self):
-        r = self.__command('/bs/rhf/v1/{brand}/{country}/configuration', dashboard=self.BASE_URL, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/rhf/v1/{brand}/{country}/configuration', dashboard=self.BASE_URL, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def battery_charge(self, vin, action='off'):
@@ -606,7 +1000,7 @@ class WeConnect():
                 }
 
             }
-        r = self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger/actions', dashboard=self.__get_fal_url(vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger/actions', dashboard=self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def climatisation(self, vin, action='off'):
@@ -616,8 +1010,7 @@ class WeConnect():
                 }
 
             }
-        secure_token = self.__request_secure_token(vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def climatisation_temperature(self, vin, temperature=21.5):
@@ -633,8 +1026,7 @@ class WeConnect():
                 }
 
             }
-        secure_token = self.__request_secure_token(vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
     def window_melt(self, vin, action='off'):
@@ -644,11 +1036,10 @@ class WeConnect():
                 }
 
             }
-        secure_token = self.__request_secure_token(vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(vin), post=data, scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
-    def __generate_secure_pin(self, challenge):
+    def generate_secure_pin(self, challenge):
         logger.info('Generating secure pin')
         if (not self.__credentials['spin']):
             raise VWError('Cannot process this command: S-PIN not provided.')
@@ -659,11 +1050,11 @@ class WeConnect():
 
     def __request_secure_token(self, vin, service):
         logger.info('Requesting secure token')
-        r = self.__command('/rolesrights/authorization/v2/vehicles/'+vin+'/services/'+service+'/security-pin-auth-requested', dashboard=self.MAL_URL, scope=self.__oauth['sc2:fal'])
+        r = self.__command('/rolesrights/authorization/v2/vehicles/'+vin+'/services/'+service+'/security-pin-auth-requested', dashboard=self.MAL_URL, scope='sc2:fal')
         logger.info('Received secure token')
         challenge = r['securityPinAuthInfo']['securityPinTransmission']['challenge']
         logger.debug('Challenge = %s', challenge)
-        secure_pin = self.__generate_secure_pin(challenge)
+        secure_pin = self.generate_secure_pin(challenge)
         data = {
             'securityPinAuthentication': {
                 'securityPin': {
@@ -674,7 +1065,7 @@ class WeConnect():
             }
         }
         logger.info('Completing security pin auth')
-        r = self.__command('/rolesrights/authorization/v2/security-pin-auth-completed', post=data, dashboard=self.MAL_URL, scope=self.__oauth['sc2:fal'])
+        r = self.__command('/rolesrights/authorization/v2/security-pin-auth-completed', post=data, dashboard=self.MAL_URL, scope='sc2:fal')
         logger.info('Completed security pin auth')
         if ('securityToken' in r):
             logger.info('Received security token')
@@ -682,14 +1073,43 @@ class WeConnect():
         logger.error('No security token found')
         return None
 
+    def get_secure_token(self, vin, service):
+        # returns a security token and True if it was taken from the cache
+        cached = self.__secure_tokens.get((vin, service))
+        if (cached and cached[1]+self.SECURE_TOKEN_TTL > time.time()):
+            logger.info('Reusing secure token for %s', service)
+            return cached[0], True
+        secure_token = self.__request_secure_token(vin, service)
+        if (secure_token):
+            self.__secure_tokens[(vin, service)] = (secure_token, time.time())
+        return secure_token, False
+
+    def secure_token_rejected(self, vin, service, cached, e):
+        # True if the command failed because of a cached security token, which is dropped so the next get_secure_token does a new handshake
+        if (not cached or e.status_code not in (401, 403)):
+            return False
+        logger.info('Cached secure token for %s rejected. Requesting a new one', service)
+        self.__secure_tokens.pop((vin, service), None)
+        return True
+
+    def __secure_command(self, vin, service, command, **kwargs):
+        # command with S-PIN security token, a rejected cached token is replaced by a new handshake once
+        secure_token, cached = self.get_secure_token(vin, service)
+        try:
+            return self.__command(command, secure_token=secure_token, **kwargs)
+        except UrlError as e:
+            if (not self.secure_token_rejected(vin, service, cached, e)):
+                raise
+            secure_token, cached = self.get_secure_token(vin, service)
+            return self.__command(command, secure_token=secure_token, **kwargs)
+
     def heating(self, vin, action='off'):
         if (action == 'on'):
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<performAction xmlns="http://audi.de/connect/rs">\n   <quickstart>\n      <active>true</active>\n   </quickstart>\n</performAction>'
         else:
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<performAction xmlns="http://audi.de/connect/rs">\n   <quickstop>\n      <active>false</active>\n   </quickstop>\n</performAction>'
 
-        secure_token = self.__request_secure_token(vin, 'rheating_v1/operations/P_QSACT')
-        r = self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteStandheizung_v2_0_0+xml', secure_token=secure_token)
+        r = self.__secure_command(vin, 'rheating_v1/operations/P_QSACT', '/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data, scope='sc2:fal', accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteStandheizung_v2_0_0+xml')
         return r
 
     def lock(self, vin, action='lock'):
@@ -697,15 +1117,19 @@ class WeConnect():
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>unlock</action>\n</rluAction>'
         else:
             data='<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>lock</action>\n</rluAction>'
-        secure_token = self.__request_secure_token(vin, 'rlu_v1/operations/' + action.upper())
-        r = self.__command('/bs/rlu/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteLockUnlock_v1_0_0+xml', secure_token=secure_token)
+        r = self.__secure_command(vin, 'rlu_v1/operations/' + action.upper(), '/bs/rlu/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data, scope='sc2:fal', accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteLockUnlock_v1_0_0+xml')
         return r
 
-    def parse_vsr(self, j):
+    def parse_vsr(self, j, typed=False):
+        # typed: VSRRecord with numeric values and separate units instead of 'value unit' strings
         parser = VSR()
+        if (typed):
+            return parser.parse_typed(j)
         return parser.parse(j)
 
     def pso(self, vin):
-        r = self.__command('/bs/otv/v1/{brand}/{country}/vehicles/'+vin+'/configuration', dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+        r = self.__command('/bs/otv/v1/{brand}/{country}/vehicles/'+vin+'/configuration', dashboard=self.__get_fal_url(vin), scope='sc2:fal', accept=self.__accept_mbb)
         return r
 
+if (os.environ.get('WECONNECT_BACKEND')):
+    WeConnect.set_backend(os.environ['WECONNECT_BACKEND'].rstrip('/'))
@@ -10,7 +10,7 @@ import NativeAPI
 import logging
 from datetime import datetime, timedelta
 import configparser
-import json
+from poshistory import PositionHistory
 
 logger = logging.getLogger('VWVehicle')
 logger.setLevel(logging.getLogger().level)
@@ -18,16 +18,11 @@ logger.setLevel(logging.getLogger().level)
 def load_datetime(s):
     return datetime.fromisoformat(s.replace('Z','+00:00')).replace(tzinfo=None)
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-    if isinstance(obj, (datetime,)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
-
 class VWVehicle:
     __api = None
     __vin = None
     __cardata = None
+    __history = None
     __supported_services = {
         'carfinder_v1': { 'status': False },
         'trip_statistic_v1': { 'status': False },
@@ -111,6 +106,18 @@ class VWVehicle:
             return now < expiration
         return False
     
+    def __position_history(self):
+        if (self.__history is None):
+            self.__history = PositionHistory(self.__config.get('position','file',fallback='position.history'))
+        return self.__history
+
+    def get_position_history(self, start=None, end=None):
+        # recorded parking positions with start <= timestamp <= end (datetime, UTC)
+        return self.__position_history().range(start, end)
+
+    def get_last_parking(self):
+        return self.__position_history().latest()
+
     def get_position(self):
         if (self.__check_access('carfinder_v1')):
             pos = self.__api.get_position(self.__vin)
@@ -118,21 +125,14 @@ class VWVehicle:
             if (self.__config.getboolean('position','record',fallback=False)):
                 posfile = self.__config.get('position','file',fallback='position.history')
                 logger.info('Recording position to {}'.format(posfile))
-                try:
-                    with open(posfile) as json_file:
-                        data = json.load(json_file)
-                    logger.debug('Found position file')
-                except (FileNotFoundError,json.decoder.JSONDecodeError):
-                    data = []
-                    logger.debug('Position file not found')
+                history = self.__position_history()
+                last = history.latest()
                 parking = load_datetime(pos.get('storedPositionResponse',{}).get('parkingTimeUTC','1970-01-01T00:00:00Z'))
-                if (len(data) == 0 or load_datetime(data[-1]['timestamp']) < parking):
+                if (last is None or last['timestamp'] < parking):
                     logger.debug('Updating record history with new timestamp {}'.format(parking))
                     coords = pos.get('storedPositionResponse',{}).get('position',{}).get('carCoordinate',{})
-                    data.append({'timestamp': parking, 'coordinates': {'latitude': coords.get('latitude',0), 'longitude': coords.get('longitude')}})
-                    with open(self.__config.get('position','file',fallback='position.history'),'w') as json_file:
-                        json.dump(data, json_file, default=json_serial)
+                    history.append(parking, coords.get('latitude',0), coords.get('longitude'))
                     logger.debug('Record history updated')
-                elif (load_datetime(data[-1]['timestamp']) >= parking):
+                else:
                     logger.debug('No new records found. Record history not updated')
             return pos
\ No newline at end of file
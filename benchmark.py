@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Feb 15 21:30:00 2022
+
+@author: do6uk
+
+Benchmarks for the hot paths of the API and the MQTT bridge.
+Run `benchmark.py` for all benchmarks or `benchmark.py vsr` for a single one.
+Benchmarks of modules with missing dependencies (or without a local MQTT broker) are reported as skipped.
+Client benchmarks run against mockbackend.py. `--json FILE` stores the results,
+`--compare FILE` reports the changes to stored results and fails on regressions.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from loginpage import find_form, find_idk, find_meta
+from mockbackend import MockBackend, vsr_status
+from vsr import VSR
+
+def vsr_fleet(vehicles):
+    # vsr responses as the mock backend sends them: every known field, mapped values where the table has a mapping
+    rnd = random.Random(0)
+    return [vsr_status('WVWZZZ%011d' % i, rnd) for i in range(vehicles)]
+
+def linear_parse(fields, j):
+    # reference: the former parser with a linear scan of the field table per field
+    rr = {}
+    j = j['StoredVehicleDataResponse']
+    rr['vin'] = j['vin']
+    for d in j['vehicleData']['data']:
+        for f in d['field']:
+            for e in fields:
+                if (e[1] == f['id']):
+                    if (e[2] not in rr):
+                        rr[e[2]] = {}
+                    rr[e[2]][e[3]] = 'null'
+                    if ('value' in f):
+                        if (len(e) == 5 and f['value'] in e[4]):
+                            rr[e[2]][e[3]] = e[4][f['value']]
+                        else:
+                            rr[e[2]][e[3]] = f['value'] if f['value'] else 'null'
+                    if ('unit' in f):
+                        rr[e[2]][e[3]] += ' '+f['unit']
+                    break
+    return rr
+
+def timeit(func, rounds):
+    best = None
+    for i in range(rounds):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None or t < best else best
+    return best
+
+def bench_vsr(args):
+    docs = vsr_fleet(args.vehicles)
+    parser = VSR()
+    # the table before de-duplication had the tyre pressure block twice
+    table = VSR._VSR__vsr_fields
+    table = table + [e for e in table if e[2] == 'tyre_pressure' and e[3] != 'difference_spare']
+    linear = timeit(lambda: [linear_parse(table, j) for j in docs], args.rounds)
+    indexed = timeit(lambda: parser.parse_many(docs), args.rounds)
+    typed = timeit(lambda: parser.parse_many(docs, typed=True), args.rounds)
+    return {
+        'vehicles': args.vehicles,
+        'linear_s': linear,
+        'indexed_s': indexed,
+        'typed_s': typed,
+        'docs_per_s': args.vehicles / indexed,
+        'speedup': linear / indexed,
+        }
+
+def login_page(body, filler=200):
+    # identity.vwgroup.io like page: lots of head and markup around the few tags the login needs
+    head = ''.join('<link rel="stylesheet" href="/static/css/app{}.css"><script src="/static/js/chunk{}.js"></script>\n'.format(i, i) for i in range(filler // 10))
+    markup = ''.join('<div class="row row-{0}"><span class="label" data-i="{0}">Text {0} &amp; more</span><a href="/help?p={0}&amp;l=de">?</a></div>\n'.format(i) for i in range(filler))
+    return '<!DOCTYPE html><html><head><meta charset="utf-8"><meta name="identitykit" content="{}">{}</head><body>{}{}</body></html>'.format(body[0], head, markup, body[1])
+
+def login_pages(filler=200):
+    hidden = '<input type="hidden" name="_csrf" value="d9f1a2b3-c4d5"><input type="hidden" name="relayState" value="7c2b9e0a1f"><input type="hidden" name="hmac" value="a1b2c3d4e5f6">'
+    form = '<form id="emailPasswordForm" method="POST" action="/signin-service/v1/9496332b@apps_vw-dilab_com/login/identifier?x=1&amp;y=2">'+hidden+'<input type="email" name="email"></form>'
+    idk = '<script>\nwindow._IDK = {\n  templateModel: {hmac: \'f0e1d2c3\', identifierUrl: \'login/identifier\', postAction: \'login/authenticate\', relayState: \'7c2b9e0a1f\'},\n  csrf_token: \'d9f1a2b3-c4d5\',\n  baseUrl: \'https://identity.vwgroup.io\'\n}\n</script>'
+    return [
+        login_page(('login', form), filler),
+        login_page(('loginAuthenticate', idk), filler),
+        login_page(('termsAndConditions', form), filler),
+        ]
+
+LOGIN_PAGES = ('login.html', 'loginAuthenticate.html', 'termsAndConditions.html')
+
+def recorded_pages(path):
+    # saved and sanitised login pages of the identity server, one file per page of LOGIN_PAGES
+    pages = []
+    for name in LOGIN_PAGES:
+        with open(os.path.join(path, name), encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+def extract_targeted(pages):
+    return (find_form(pages[0], 'emailPasswordForm'), find_idk(pages[1]), find_meta(pages[2], 'identitykit'), find_form(pages[2], 'emailPasswordForm'))
+
+def extract_soup(BeautifulSoup, pages):
+    # reference: the former extraction with a full parse tree per page
+    soup = BeautifulSoup(pages[0], 'html.parser')
+    form = soup.find('form', {'id': 'emailPasswordForm'})
+    post = {h['name']: h['value'] for h in form.find_all('input', {'type': 'hidden'})}
+    soup = BeautifulSoup(pages[1], 'html.parser')
+    for script in soup.find_all('script'):
+        if script.string and 'window._IDK' in script.string:
+            idk_txt = '{'+re.search(r'\{(.*)\}', script.string, re.M|re.S).group(1)+'}'
+            idk = json.loads(re.sub(r'([\{\s,])(\w+)(:)', r'\1"\2"\3', idk_txt.replace('\'','"')))
+    soup = BeautifulSoup(pages[2], 'html.parser')
+    metakits = [m['content'] for m in soup.find_all('meta', {'name': 'identitykit'})]
+    form = soup.find('form', {'id': 'emailPasswordForm'})
+    return (form['action'], post, idk, metakits)
+
+def bench_login(args):
+    # extraction of form, _IDK and identitykit meta from the login pages, without the round trips
+    # synthetic pages unless --pages points to recorded ones, so results of the two do not compare
+    pages = recorded_pages(args.pages) if args.pages else login_pages()
+    targeted = timeit(lambda: extract_targeted(pages), args.rounds * 20)
+    result = {'page_bytes': sum(len(p) for p in pages), 'targeted_s': targeted}
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        result['soup_s'] = result['speedup'] = None
+        return result
+    ref = extract_soup(BeautifulSoup, pages)
+    got = extract_targeted(pages)
+    if (got[0][0]['action'] != ref[0] or got[0][1] != ref[1] or got[1] != ref[2] or got[2] != ref[3]):
+        raise AssertionError('targeted extraction differs from BeautifulSoup')
+    result['soup_s'] = timeit(lambda: extract_soup(BeautifulSoup, pages), args.rounds)
+    result['speedup'] = result['soup_s'] / targeted
+    return result
+
+@contextmanager
+def mock_api(vehicles=1, latency=0.0):
+    # WeConnect class pointed to a fresh mock backend, with its files in a temporary directory and no rate limit
+    from NativeAPI import WeConnect
+    backend = MockBackend(vehicles=vehicles, latency=latency).start()
+    tmp = tempfile.mkdtemp(prefix='weconnect-bench-')
+    saved = {k: getattr(WeConnect, k) for k in ('BASE_URL', 'TOKEN_URL', 'PROFILE_URL', 'OAUTH_URL', 'REGISTER_URL', 'USER_URL', 'MAL_URL', 'IDENTITY_URL',
+        'CREDENTIAL_FILE', 'SESSION_FILE', 'ACCESS_FILE', 'HOMEREGION_FILE', 'RATE_LIMIT', 'HOST_RATE_LIMIT')}
+    try:
+        WeConnect.set_backend(backend.url)
+        for k in ('CREDENTIAL_FILE', 'SESSION_FILE', 'ACCESS_FILE', 'HOMEREGION_FILE'):
+            setattr(WeConnect, k, os.path.join(tmp, saved[k]))
+        WeConnect.RATE_LIMIT = WeConnect.HOST_RATE_LIMIT = (1e6, 1e6)
+        yield backend, WeConnect
+    finally:
+        for k, v in saved.items():
+            setattr(WeConnect, k, v)
+        backend.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def bench_command(args):
+    # per-call cost of a vsr request through __command (token check, headers, logging) vs the bare HTTP request
+    try:
+        import requests
+    except ImportError:
+        return {'command_s': None, 'raw_s': None, 'overhead_s': None}
+    calls = 200
+    with mock_api() as (backend, WeConnect):
+        api = WeConnect()
+        api.login()
+        vin = next(iter(backend.cars))
+        api.get_vsr(vin)
+        command = timeit(lambda: [api.get_vsr(vin) for i in range(calls)], args.rounds) / calls
+        session = requests.Session()
+        url, headers = api.prepare_command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=api.get_fal_url(vin), scope='sc2:fal')
+        raw = timeit(lambda: [session.get(url, headers=headers).json() for i in range(calls)], args.rounds) / calls
+    return {'command_s': command, 'raw_s': raw, 'overhead_s': command - raw}
+
+def bench_login_flow(args):
+    # full login (no stored tokens) vs start with valid tokens in the credential store
+    if (importlib.util.find_spec('requests') is None):
+        # the only third-party dependency of NativeAPI, imported by mock_api
+        return {'cold_s': None, 'warm_s': None}
+    with mock_api() as (backend, WeConnect):
+        def cold():
+            if (os.path.exists(WeConnect.CREDENTIAL_FILE)):
+                os.remove(WeConnect.CREDENTIAL_FILE)
+            WeConnect().login()
+        cold_s = timeit(cold, args.rounds)
+        warm_s = timeit(lambda: WeConnect().login(), args.rounds)
+        # clients with different credential stores must not share tokens
+        first = WeConnect()
+        first.login()
+        headers = first.prepare_command('/vehicles', dashboard=WeConnect.BASE_URL, scope='sc2:fal')[1]
+        WeConnect.CREDENTIAL_FILE += '.other'
+        WeConnect().login()
+        if (first.prepare_command('/vehicles', dashboard=WeConnect.BASE_URL, scope='sc2:fal')[1] != headers):
+            raise RuntimeError('tokens shared between clients with different credential stores')
+    return {'cold_s': cold_s, 'warm_s': warm_s, 'speedup': cold_s / warm_s}
+
+def bench_mqtt(args):
+    # get/charger published to a local broker until charger/level arrives, bridge and mock backend in this process
+    skipped = {'latency_s': None, 'median_s': None}
+    try:
+        import paho.mqtt.client as mqtt
+        import weconnectMQTT as bridge
+    except ImportError:
+        return skipped
+    with mock_api() as (backend, WeConnect):
+        vin = next(iter(backend.cars))
+        bridge.mycars = [{'vin': vin, 'name': 'Mock', 'topic': 'mock', 'plate': 'MOCK', 'active': True, 'lat': 0, 'lon': 0}]
+        bridge.mqtt_base_topic = '/weconnectMQTTbench/'
+        bridge.mqtt_changes_only = False
+        bridge.telemetry_enabled = False
+        bridge.geocode_file = None
+        bridge.build_runtime()
+        bridge.mqtt_connect()
+        if (not bridge.mconnect):
+            return skipped
+        base = bridge.mqtt_base_topic+'mock/'
+        received = threading.Event()
+        observer = mqtt.Client('weconnect-bench-{}'.format(os.getpid()))
+        observer.on_message = lambda client, userdata, message: received.set()
+        try:
+            bridge.build_routes()
+            bridge.mclient.loop_start()
+            bridge.mclient.subscribe(base+'get/#')
+            observer.connect(bridge.mqtt_broker, bridge.mqtt_port)
+            observer.loop_start()
+            observer.subscribe(base+'charger/level')
+            time.sleep(0.5)
+            latencies = []
+            for i in range(max(args.rounds, 10)):
+                received.clear()
+                t = time.perf_counter()
+                observer.publish(base+'get/charger', 1)
+                if (not received.wait(10)):
+                    return skipped
+                latencies.append(time.perf_counter() - t)
+        finally:
+            observer.loop_stop()
+            observer.disconnect()
+            bridge.mclient.loop_stop()
+            bridge.mclient.disconnect()
+    latencies.sort()
+    return {'latency_s': latencies[0], 'median_s': latencies[len(latencies)//2]}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_MODULES = ('vsr', 'cache', 'telemetry', 'NativeAPI', 'AsyncAPI', 'weconnectMQTT')
+
+def run_python(args, rounds):
+    # best wall time of a fresh interpreter, None if it fails (e.g. a dependency is not installed)
+    def run():
+        subprocess.run([sys.executable] + args, cwd=HERE, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return timeit(run, rounds)
+    except subprocess.CalledProcessError:
+        return None
+
+def bench_import(args):
+    # import time of each module in a fresh interpreter, without the interpreter startup
+    base = run_python(['-c', 'pass'], args.rounds)
+    result = {'interpreter_s': base}
+    for module in IMPORT_MODULES:
+        t = run_python(['-c', 'import '+module], args.rounds)
+        result[module+'_s'] = None if t is None else max(0, t - base)
+    return result
+
+def bench_startup(args):
+    # weconnectMQTT.py up to the parsed arguments, no MQTT connect or login
+    base = run_python(['-c', 'pass'], args.rounds)
+    t = run_python(['weconnectMQTT.py', '--version'], args.rounds)
+    return {'startup_s': None if t is None else max(0, t - base)}
+
+BENCHMARKS = {
+    'vsr': bench_vsr,
+    'import': bench_import,
+    'startup': bench_startup,
+    'login': bench_login,
+    'command': bench_command,
+    'login_flow': bench_login_flow,
+    'mqtt': bench_mqtt,
+    }
+
+def higher_is_better(key):
+    return key == 'speedup' or key.endswith('_per_s')
+
+def compare(old, new, threshold):
+    # changes of all timings and rates against stored results, True if one got worse by more than threshold
+    regression = False
+    for name, result in new.items():
+        for k, v in result.items():
+            o = old.get(name, {}).get(k)
+            if (not isinstance(v, (int, float)) or not isinstance(o, (int, float)) or not o or k in ('vehicles', 'page_bytes')):
+                continue
+            change = v / o - 1
+            worse = -change if higher_is_better(k) else change
+            flag = ''
+            if (worse > threshold):
+                flag = '  REGRESSION'
+                regression = True
+            print('{}.{}: {} -> {} ({:+.1%}){}'.format(name, k, format_value(o), format_value(v), change, flag))
+    return regression
+
+def format_value(v):
+    if (v is None):
+        return 'skipped'
+    return '{:.6g}'.format(v)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the WeConnect API')
+    parser.add_argument('benchmark', nargs='*', help='benchmarks to run (default: all): {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--vehicles', type=int, default=500, help='fleet size')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds per benchmark, the best round counts')
+    parser.add_argument('--pages', help='directory with recorded login pages ({}) for the login benchmark, default: synthetic pages'.format(', '.join(LOGIN_PAGES)))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with the results in this file, exit code 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.1, help='share a result may get worse before it counts as regression')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    random.seed(0)
+    results = {}
+    for name in (args.benchmark or BENCHMARKS):
+        result = BENCHMARKS[name](args)
+        results[name] = result
+        print('{}: {}'.format(name, ', '.join('{}={}'.format(k, format_value(v)) for k, v in result.items())))
+    if (args.json):
+        with open(args.json, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'machine': platform.machine(),
+                'vehicles': args.vehicles, 'rounds': args.rounds, 'results': results}, f, indent=2)
+    if (args.compare):
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('\ncompared with {} ({})'.format(args.compare, old.get('time')))
+        if (old.get('vehicles') != args.vehicles or old.get('rounds') != args.rounds):
+            print('note: stored results ran with --vehicles {} --rounds {}'.format(old.get('vehicles'), old.get('rounds')))
+        if (compare(old['results'], results, args.threshold)):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Feb 16 19:05:00 2022
+
+@author: do6uk
+
+LRU cache for GET responses of NativeAPI.WeConnect with a TTL per endpoint class.
+Only endpoints that rarely change are cached (configuration, vehicle data,
+roles/rights, profile), status endpoints like vsr, charger or climater are not.
+Responses are copied in and out, callers may modify what they get.
+"""
+import copy
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('API')
+
+class ResponseCache():
+    # endpoint class -> TTL in seconds
+    DEFAULT_TTLS = {
+        'configuration': 24*3600,
+        'vehicle': 3600,
+        'vehicledata': 300, # includes isConnect, the online state of the car
+        'profile': 3600,
+        }
+    # endpoint class -> pattern of the command path, first match wins
+    ENDPOINT_CLASSES = [
+        ('configuration', re.compile(r'(geofencingConfiguration|speedAlertConfiguration|/rhf/v1/[^/]+/[^/]+/configuration|/otv/v1/.*/configuration)$')),
+        ('vehicledata', re.compile(r'/vehicleMgmt/vehicledata/')),
+        ('vehicle', re.compile(r'(/rolesrights/operationlist/|/fetched-role$|/usermanagement/users/v1/[^/]+/[^/]+/vehicles$)')),
+        ('profile', re.compile(r'/(personalData|realCarData|mbbStatusData|identityData)$')),
+        ]
+    VIN_PATTERN = re.compile(r'/vehicles?/([^/?]+)')
+
+    def __init__(self, ttls=None, maxsize=256):
+        self.__ttls = dict(self.DEFAULT_TTLS)
+        if (ttls):
+            self.__ttls.update(ttls)
+        self.__maxsize = maxsize
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def endpoint_class(self, url):
+        path = url.split('?')[0]
+        for name, pattern in self.ENDPOINT_CLASSES:
+            if (pattern.search(path)):
+                return name if self.__ttls.get(name) else None
+        return None
+
+    def get(self, key):
+        # returns a copy of the cached response or None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if (entry and entry[0] > time.time()):
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                logger.debug('Cache hit: %s', key[0])
+                return copy.deepcopy(entry[1])
+            if (entry):
+                del self.__entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, endpoint_class, value):
+        value = copy.deepcopy(value)
+        with self.__lock:
+            self.__entries[key] = (time.time()+self.__ttls[endpoint_class], value)
+            self.__entries.move_to_end(key)
+            while (len(self.__entries) > self.__maxsize):
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, vin=None):
+        # drops all entries of a vehicle, or everything without vin
+        with self.__lock:
+            if (vin is None):
+                n = len(self.__entries)
+                self.__entries.clear()
+            else:
+                keys = [k for k in self.__entries if '/'+vin in k[0]]
+                n = len(keys)
+                for k in keys:
+                    del self.__entries[k]
+            self.invalidations += n
+        logger.debug('Cache invalidated %d entries for %s', n, vin if vin else 'all vehicles')
+
+    def invalidate_url(self, url):
+        # write actions on a vehicle drop its entries, posts without vehicle (e.g. secure pin) keep the cache
+        m = self.VIN_PATTERN.search(url)
+        if (m):
+            self.invalidate(m.group(1))
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations, 'size': len(self.__entries)}
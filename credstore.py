@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Feb 22 20:10:00 2022
+
+@author: do6uk
+
+Credential store shared by all processes using the same account (service, CLI calls).
+The data is one JSON document, written to a temporary file and renamed over the old one,
+so readers never see a partly written file. Writers and token refreshes hold an exclusive
+lock on <file>.lock (fcntl, where available), so two processes do not refresh the same token.
+"""
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('API')
+
+class CredentialStore():
+
+    def __init__(self, file):
+        self.__file = file
+        self.__lock_file = file+'.lock'
+        self.__lock = threading.RLock()
+        self.__depth = 0
+        self.__fd = None
+        self.__mtime = None
+
+    @contextmanager
+    def locked(self):
+        # exclusive for threads and processes, reentrant within a thread
+        with self.__lock:
+            if (self.__depth == 0 and fcntl):
+                self.__fd = os.open(self.__lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            self.__depth += 1
+            try:
+                yield
+            finally:
+                self.__depth -= 1
+                if (self.__depth == 0 and self.__fd is not None):
+                    fcntl.flock(self.__fd, fcntl.LOCK_UN)
+                    os.close(self.__fd)
+                    self.__fd = None
+
+    def __stat(self):
+        try:
+            return os.stat(self.__file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        # True if another process wrote the store since our last read or write
+        return self.__stat() != self.__mtime
+
+    def read(self):
+        try:
+            mtime = self.__stat()
+            with open(self.__file) as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.decoder.JSONDecodeError:
+            logger.warning('Credential store %s not readable', self.__file)
+            return None
+        self.__mtime = mtime
+        return d
+
+    def write(self, d):
+        with self.locked():
+            tmp = self.__file+'.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(d, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.__file)
+            self.__mtime = self.__stat()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@name:		dispatcher
+@date:		2022-02-14
+@author:	do6uk
+
+Worker-pool for weconnectMQTT: commands are queued by a key (the VIN of the car)
+Jobs with the same key run one after another in order of arrival, jobs with different keys run in parallel
+submit() never waits for a job, so it is safe to call it from the paho network-thread
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('weconnectMQTT')
+
+class Dispatcher:
+
+	def __init__(self, workers=4, maxqueue=100):
+		self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatch')
+		self.__lock = threading.Lock()
+		self.__queues = {}	# key -> deque of waiting jobs, key exists while a worker is draining it
+		self.__pending = 0
+		self.__maxqueue = maxqueue
+
+	def submit(self, key, func, *args):
+		with self.__lock:
+			if self.__pending >= self.__maxqueue:
+				logger.warning('DISPATCH queue full - dropping job {} for {}'.format(func.__name__,key))
+				return False
+			self.__pending += 1
+			if key in self.__queues:
+				self.__queues[key].append((func,args))
+				logger.debug('DISPATCH queued {} for {} behind running job'.format(func.__name__,key))
+				return True
+			self.__queues[key] = deque([(func,args)])
+		self.__pool.submit(self.__drain, key)
+		return True
+
+	def __drain(self, key):
+		while True:
+			with self.__lock:
+				queue = self.__queues[key]
+				if not queue:
+					del self.__queues[key]
+					return
+				func,args = queue.popleft()
+			try:
+				func(*args)
+			except Exception:
+				logger.exception('DISPATCH job {} for {} failed'.format(func.__name__,key))
+			finally:
+				with self.__lock:
+					self.__pending -= 1
+
+	def pending(self):
+		with self.__lock:
+			return self.__pending
+
+	def shutdown(self, wait=True):
+		self.__pool.shutdown(wait=wait)
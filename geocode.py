@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+@name:		geocode
+@date:		2022-02-17
+@author:	do6uk
+
+Reverse-geocoding for weconnectMQTT with a cache keyed by geohash cells
+A parked car reports the same coordinates for hours, so the address of a cell is asked only once
+The backend is a function (lat, lon) -> address or None, default is OSM Nominatim
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('weconnectMQTT')
+
+GEOHASH_CHARS = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, lon, precision=8):
+	# precision 8 is a cell of about 38m x 19m
+	lat_range = [-90.0, 90.0]
+	lon_range = [-180.0, 180.0]
+	chars = []
+	bits = 0
+	bit = 0
+	even = True
+	while len(chars) < precision:
+		rng, val = (lon_range, lon) if even else (lat_range, lat)
+		mid = (rng[0]+rng[1])/2
+		if val >= mid:
+			bits = bits*2+1
+			rng[0] = mid
+		else:
+			bits = bits*2
+			rng[1] = mid
+		even = not even
+		bit += 1
+		if bit == 5:
+			chars.append(GEOHASH_CHARS[bits])
+			bits = 0
+			bit = 0
+	return ''.join(chars)
+
+def nominatim(lat, lon, timeout=5):
+	import requests
+	data = requests.get('https://nominatim.openstreetmap.org/search.php', params={'q': str(lat)+','+str(lon), 'polygon_geojson': 1, 'format': 'jsonv2'}, timeout=timeout)
+	j = data.json()
+	if len(j) > 0:
+		return j[0]['display_name']
+	return None
+
+class Geocoder:
+
+	def __init__(self, backend=nominatim, precision=8, maxsize=1024, file=None):
+		self.__backend = backend
+		self.__precision = precision
+		self.__maxsize = maxsize
+		self.__file = file
+		self.__cells = OrderedDict()
+		self.__lock = threading.Lock()
+		self.__save_lock = threading.Lock()	# one writer of the cache file at a time
+		self.hits = 0
+		self.misses = 0
+		self.__loaded = not file	# the cache file is read on the first lookup
+
+	def lookup(self, lat, lon):
+		cell = geohash(lat, lon, self.__precision)
+		if not self.__loaded:
+			self.load()
+		with self.__lock:
+			if cell in self.__cells:
+				self.__cells.move_to_end(cell)
+				self.hits += 1
+				return self.__cells[cell]
+			self.misses += 1
+		name = self.__backend(lat, lon)
+		logger.debug('GEOCODE cell {} > {}'.format(cell,name))
+		if name is None:
+			return None
+		with self.__lock:
+			self.__cells[cell] = name
+			while len(self.__cells) > self.__maxsize:
+				self.__cells.popitem(last=False)
+		if self.__file:
+			self.save()
+		return name
+
+	def load(self):
+		# once, under the lock: cells found meanwhile are kept and stay the most recent ones
+		with self.__lock:
+			if self.__loaded:
+				return
+			self.__loaded = True
+			try:
+				with open(self.__file) as f:
+					cells = json.load(f)
+			except (FileNotFoundError, json.decoder.JSONDecodeError):
+				logger.info('GEOCODE no cache file {}'.format(self.__file))
+				return
+			merged = OrderedDict(cells)
+			for cell, name in self.__cells.items():
+				merged.pop(cell, None)
+				merged[cell] = name
+			self.__cells = OrderedDict(list(merged.items())[-self.__maxsize:])
+			logger.debug('GEOCODE loaded {} cells'.format(len(cells)))
+
+	def save(self):
+		with self.__save_lock:
+			with self.__lock:
+				cells = dict(self.__cells)
+			tmp = self.__file+'.tmp'
+			with open(tmp, 'w') as f:
+				json.dump(cells, f)
+			os.replace(tmp, self.__file)
+
+	def stats(self):
+		with self.__lock:
+			return {'hits': self.hits, 'misses': self.misses, 'size': len(self.__cells)}
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb 21 19:05:00 2022
+
+@author: do6uk
+
+Extraction of the few things the login needs from the identity.vwgroup.io pages:
+a form with its hidden inputs, the window._IDK object and the identitykit meta tags.
+The pages are searched for these tags only, no parse tree is built.
+"""
+import html
+import json
+import re
+
+TAG_ATTR = re.compile(r'''([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+FORM_TAG = re.compile(r'<form\b([^>]*)>(.*?)</form\s*>', re.I|re.S)
+INPUT_TAG = re.compile(r'<input\b([^>]*)>', re.I)
+META_TAG = re.compile(r'<meta\b([^>]*)>', re.I)
+SCRIPT_TAG = re.compile(r'<script\b[^>]*>(.*?)</script\s*>', re.I|re.S)
+IDK_KEY = re.compile(r'([\{\s,])(\w+)(:)')
+
+def attributes(tag):
+    # attributes of a tag as dict, entities decoded like an HTML parser does
+    return {m.group(1).lower(): html.unescape(m.group(2) if m.group(2) is not None else m.group(3) if m.group(3) is not None else m.group(4)) for m in TAG_ATTR.finditer(tag)}
+
+def find_form(text, form_id):
+    # (attributes, {name: value} of the hidden inputs) of the form with id form_id or None
+    for m in FORM_TAG.finditer(text):
+        if (form_id not in m.group(1)):
+            continue
+        attrs = attributes(m.group(1))
+        if (attrs.get('id') != form_id):
+            continue
+        hidden = {}
+        for i in INPUT_TAG.finditer(m.group(2)):
+            a = attributes(i.group(1))
+            if (a.get('type', '').lower() == 'hidden' and 'name' in a):
+                hidden[a['name']] = a.get('value', '')
+        return attrs, hidden
+    return None
+
+def find_idk(text):
+    # window._IDK object of the password page, its keys are not quoted
+    for m in SCRIPT_TAG.finditer(text):
+        script = m.group(1)
+        if ('window._IDK' not in script):
+            continue
+        start = script.find('{')
+        end = script.rfind('}')
+        if (start < 0 or end < start):
+            return None
+        idk_txt = IDK_KEY.sub(r'\1"\2"\3', script[start:end+1].replace('\'','"'))
+        return json.loads(idk_txt)
+    return None
+
+def find_meta(text, name):
+    # content of all meta tags with this name
+    result = []
+    for m in META_TAG.finditer(text):
+        if (name not in m.group(1)):
+            continue
+        attrs = attributes(m.group(1))
+        if (attrs.get('name') == name and 'content' in attrs):
+            result.append(attrs['content'])
+    return result
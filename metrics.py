@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Feb 24 19:20:00 2022
+
+@author: do6uk
+
+Request metrics of the API: latency histograms per logical endpoint (vsr, charger, ...),
+response status counters, bytes sent and received and token refresh counts.
+Readable in-process with snapshot(), as Prometheus text with prometheus() or served
+over HTTP with start_http_server().
+"""
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('API')
+
+class Histogram():
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+class Metrics():
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # logical endpoint by method and url, first match wins
+    ENDPOINTS = [
+        ('secure_pin', None, re.compile(r'/security-pin-auth-')),
+        ('token_refresh', None, re.compile(r'/refreshTokens$|/oauth2/v1/token$')),
+        ('login', None, re.compile(r'/oidc/|/signin-service/|/exchangeAuthCode$|/register/v1$|^carnet:')),
+        ('homeregion', 'GET', re.compile(r'/homeRegion$')),
+        ('vsr', 'GET', re.compile(r'/bs/vsr/v1/.*/status$')),
+        ('charger', 'GET', re.compile(r'/bs/batterycharge/v1/.*/charger$')),
+        ('climater', 'GET', re.compile(r'/bs/climatisation/v1/.*/climater$')),
+        ('position', 'GET', re.compile(r'/bs/cf/v1/.*/position$')),
+        ('action', 'POST', re.compile(r'/actions$|/honkAndFlash$|/bs/vsr/v1/.*/requests$')),
+        ('profile', None, re.compile(r'/customers/')),
+        ]
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__latency = {}
+            self.__status = {}
+            self.__bytes_in = {}
+            self.__bytes_out = {}
+            self.__refreshes = {}
+
+    def endpoint(self, method, url):
+        path = url.split('?', 1)[0]
+        for name, m, pattern in self.ENDPOINTS:
+            if ((m is None or m == method) and pattern.search(path)):
+                return name
+        return 'other'
+
+    def observe(self, endpoint, seconds, status, bytes_out=0, bytes_in=0):
+        # one HTTP request, status is the response code or 'error' if no response was received
+        with self.__lock:
+            h = self.__latency.get(endpoint)
+            if (h is None):
+                h = self.__latency[endpoint] = Histogram(self.BUCKETS)
+            for i, le in enumerate(self.BUCKETS):
+                if (seconds <= le):
+                    h.counts[i] += 1
+                    break
+            h.count += 1
+            h.sum += seconds
+            h.max = max(h.max, seconds)
+            key = (endpoint, str(status))
+            self.__status[key] = self.__status.get(key, 0) + 1
+            self.__bytes_out[endpoint] = self.__bytes_out.get(endpoint, 0) + bytes_out
+            self.__bytes_in[endpoint] = self.__bytes_in.get(endpoint, 0) + bytes_in
+
+    def token_refreshed(self, name):
+        with self.__lock:
+            self.__refreshes[name] = self.__refreshes.get(name, 0) + 1
+
+    def snapshot(self):
+        with self.__lock:
+            endpoints = {}
+            for name, h in self.__latency.items():
+                endpoints[name] = {
+                    'count': h.count,
+                    'avg': h.sum / h.count if h.count else None,
+                    'max': h.max,
+                    'buckets': dict(zip(self.BUCKETS, h.counts)),
+                    'status': {s: n for (e, s), n in self.__status.items() if e == name},
+                    'bytes_out': self.__bytes_out.get(name, 0),
+                    'bytes_in': self.__bytes_in.get(name, 0),
+                    }
+            return {'endpoints': endpoints, 'token_refreshes': dict(self.__refreshes)}
+
+    def prometheus(self, prefix='weconnect'):
+        lines = []
+        with self.__lock:
+            lines.append('# HELP {}_request_duration_seconds Duration of backend requests by endpoint'.format(prefix))
+            lines.append('# TYPE {}_request_duration_seconds histogram'.format(prefix))
+            for name, h in sorted(self.__latency.items()):
+                total = 0
+                for le, n in zip(self.BUCKETS, h.counts):
+                    total += n
+                    lines.append('{}_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(prefix, name, le, total))
+                lines.append('{}_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'.format(prefix, name, h.count))
+                lines.append('{}_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(prefix, name, h.sum))
+                lines.append('{}_request_duration_seconds_count{{endpoint="{}"}} {}'.format(prefix, name, h.count))
+            lines.append('# HELP {}_responses_total Backend responses by endpoint and status code'.format(prefix))
+            lines.append('# TYPE {}_responses_total counter'.format(prefix))
+            for (name, status), n in sorted(self.__status.items()):
+                lines.append('{}_responses_total{{endpoint="{}",status="{}"}} {}'.format(prefix, name, status, n))
+            for metric, values, text in (('request_bytes_total', self.__bytes_out, 'Bytes sent'), ('response_bytes_total', self.__bytes_in, 'Bytes received')):
+                lines.append('# HELP {}_{} {} by endpoint'.format(prefix, metric, text))
+                lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+                for name, n in sorted(values.items()):
+                    lines.append('{}_{}{{endpoint="{}"}} {}'.format(prefix, metric, name, n))
+            lines.append('# HELP {}_token_refreshes_total Token refreshes by token'.format(prefix))
+            lines.append('# TYPE {}_token_refreshes_total counter'.format(prefix))
+            for name, n in sorted(self.__refreshes.items()):
+                lines.append('{}_token_refreshes_total{{token="{}"}} {}'.format(prefix, name, n))
+        return '\n'.join(lines)+'\n'
+
+    def start_http_server(self, port=9120, host='127.0.0.1'):
+        # serves prometheus() on http://host:port/metrics in a daemon thread, local only unless host is '' or an address
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if (self.path.split('?')[0] != '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info('Serving metrics on %s:%d', *server.server_address[:2])
+        return server
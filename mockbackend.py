@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Feb 23 20:30:00 2022
+
+@author: do6uk
+
+Local stand-in for the VW backend: login pages of identity.vwgroup.io, token and OAuth
+services, homeRegion, vsr, charger, climater, position, the S-PIN handshake and the actions.
+All hosts are served by one server, the paths do not overlap. Point the client to it with
+`WeConnect.set_backend(url)` or the environment variable WECONNECT_BACKEND.
+
+Run `mockbackend.py --port 8080 --vehicles 10 --latency 0.2 --error-rate 0.01` or use
+MockBackend(...).start() in benchmarks.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+from vsr import VSR
+
+logger = logging.getLogger('mockbackend')
+
+CLIENT = '9496332b-ea03-4091-a224-8c746b885068@apps_vw-dilab_com'
+USER_ID = 'b0a3e7f2-0000-4000-8000-mockuser0001'
+TS = '2022-02-23T20:00:00Z'
+
+def value(content, ts=TS):
+    return {'content': content, 'timestamp': ts}
+
+def vsr_status(vin, rnd=random):
+    # StoredVehicleDataResponse with a value for every known field, grouped by data block
+    blocks = {}
+    for e in VSR._VSR__vsr_fields:
+        if (len(e) == 5):
+            v = rnd.choice(list(e[4]))
+        else:
+            v = str(rnd.randint(0, 500))
+        blocks.setdefault(e[0], []).append({
+            'id': e[1],
+            'tsCarSentUtc': TS,
+            'tsCarCaptured': TS,
+            'milCarCaptured': 0,
+            'value': v,
+            'unit': rnd.choice(['km', '%', 'dK', 'd']),
+            })
+    return {'StoredVehicleDataResponse': {'vin': vin, 'vehicleData': {'data': [{'id': b, 'field': f} for b, f in blocks.items()]}}}
+
+class Car():
+
+    def __init__(self, vin, rnd):
+        self.vin = vin
+        self.soc = rnd.randint(10, 100)
+        self.charging = False
+        self.clima = False
+        self.window = False
+        self.target = 2951
+        self.lat = rnd.randint(47000000, 55000000)
+        self.lon = rnd.randint(6000000, 15000000)
+        self.vsr = vsr_status(vin, rnd)
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server_version = 'MockVW/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        self.server.backend.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.backend.handle(self, 'POST')
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class MockBackend():
+    VIN_PATH = '(?P<vin>[A-Z0-9]{17})'
+
+    def __init__(self, host='127.0.0.1', port=0, vehicles=1, latency=0.0, jitter=0.0, error_rate=0.0, seed=0, token_ttl=3600):
+        # latency and jitter in seconds per request, error_rate: share of vehicle requests answered with 503
+        # token_ttl: seconds until an issued access token is rejected with 401, refresh tokens do not expire
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.__rnd = random.Random(seed)
+        self.cars = {}
+        for i in range(vehicles):
+            vin = 'WVWZZZMOCK%07d' % i
+            self.cars[vin] = Car(vin, self.__rnd)
+        self.requests = {}
+        self.__issued = {} # token: expiry
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), MockHandler)
+        self.__server.daemon_threads = True
+        self.__server.backend = self
+        self.__thread = None
+        self.__routes = [(method, re.compile(pattern.replace('{vin}', self.VIN_PATH)+'$'), name, handler) for method, pattern, name, handler in (
+            ('GET', '/oidc/v1/authorize', 'login', self.__authorize),
+            ('POST', '/signin-service/v1/[^/]+/login/identifier', 'login', self.__identifier),
+            ('POST', '/signin-service/v1/[^/]+/login/authenticate', 'login', self.__authenticate),
+            ('GET', '/signin-service/v1/callback/success', 'login', self.__callback),
+            ('POST', '/exchangeAuthCode', 'token', self.__tokens),
+            ('POST', '/refreshTokens', 'token', self.__tokens),
+            ('POST', '/mbbcoauth/mobile/register/v1', 'token', self.__register),
+            ('POST', '/mbbcoauth/mobile/oauth2/v1/token', 'token', self.__oauth),
+            ('GET', '/v1/customers/[^/]+/personalData', 'profile', self.__personal_data),
+            ('GET', '/v1/customers/[^/]+/realCarData', 'profile', self.__real_car_data),
+            ('GET', '/v1/customers/[^/]+/mbbStatusData', 'profile', self.__mbb_status),
+            ('GET', '/api/cs/vds/v1/vehicles/{vin}/homeRegion', 'homeregion', self.__home_region),
+            ('GET', '/api/rolesrights/authorization/v2/vehicles/{vin}/services/.+/security-pin-auth-requested', 'secure_pin', self.__pin_requested),
+            ('POST', '/api/rolesrights/authorization/v2/security-pin-auth-completed', 'secure_pin', self.__pin_completed),
+            ('GET', '/fs-car/usermanagement/users/v1/\\w+/\\w+/vehicles', 'vehicles', self.__vehicles),
+            ('GET', '/fs-car/vehicleMgmt/vehicledata/v2/\\w+/\\w+/vehicles/{vin}', 'vehicle', self.__vehicle_data),
+            ('GET', '/fs-car/bs/vsr/v1/\\w+/\\w+/vehicles/{vin}/status', 'vsr', self.__vsr),
+            ('GET', '/fs-car/bs/batterycharge/v1/\\w+/\\w+/vehicles/{vin}/charger', 'charger', self.__charger),
+            ('GET', '/fs-car/bs/climatisation/v1/\\w+/\\w+/vehicles/{vin}/climater', 'climater', self.__climater),
+            ('GET', '/fs-car/bs/cf/v1/\\w+/\\w+/vehicles/{vin}/position', 'position', self.__position),
+            ('POST', '/fs-car/bs/batterycharge/v1/\\w+/\\w+/vehicles/{vin}/charger/actions', 'action', self.__charger_action),
+            ('POST', '/fs-car/bs/climatisation/v1/\\w+/\\w+/vehicles/{vin}/climater/actions', 'action', self.__climater_action),
+            ('POST', '/fs-car/bs/rhf/v1/\\w+/\\w+/vehicles/{vin}/honkAndFlash', 'action', self.__action),
+            ('POST', '/fs-car/bs/rs/v1/\\w+/\\w+/vehicles/{vin}/actions', 'action', self.__action),
+            ('POST', '/fs-car/bs/rlu/v1/\\w+/\\w+/vehicles/{vin}/actions', 'action', self.__action),
+            ('POST', '/fs-car/bs/vsr/v1/\\w+/\\w+/vehicles/{vin}/requests', 'action', self.__action),
+            )]
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='mockbackend', daemon=True)
+        self.__thread.start()
+        logger.info('Mock backend listening on %s with %d vehicles', self.url, len(self.cars))
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.requests)
+
+    def handle(self, request, method):
+        upr = urlparse(request.path)
+        length = int(request.headers.get('Content-Length', 0))
+        body = request.rfile.read(length) if length else b''
+        for m, pattern, name, handler in self.__routes:
+            match = pattern.match(upr.path) if m == method else None
+            if (match):
+                break
+        else:
+            return self.__send(request, 404, {'error': {'errorCode': 'gw.error.notfound', 'description': 'Not found'}})
+        with self.__lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if (self.latency or self.jitter):
+            time.sleep(max(0, self.latency + self.__rnd.uniform(-self.jitter, self.jitter)))
+        vin = match.groupdict().get('vin')
+        if (vin is not None and vin not in self.cars):
+            return self.__send(request, 404, {'error': {'errorCode': 'gw.error.vehicle', 'description': 'Unknown vehicle'}})
+        if (name not in ('login', 'token') and not self.__valid(request.headers.get('Authorization', '').replace('Bearer ', '', 1))):
+            return self.__unauthorized(request)
+        if (self.error_rate and name not in ('login', 'token') and self.__rnd.random() < self.error_rate):
+            return self.__send(request, 503, {'error': {'errorCode': 'gw.error.unavailable', 'description': 'Service unavailable'}}, {'Retry-After': '1'})
+        query = {k: v[0] for k, v in parse_qs(upr.query).items()}
+        if (body and request.headers.get('Content-Type', '').startswith('application/json')):
+            data = json.loads(body)
+        else:
+            data = {k: v[0] for k, v in parse_qs(body.decode(errors='replace')).items()}
+        handler(request, vin, query, data)
+
+    def __send(self, request, status, body=None, headers=None, content_type='application/json'):
+        if (isinstance(body, (dict, list))):
+            body = json.dumps(body)
+        body = (body or '').encode()
+        request.send_response(status)
+        request.send_header('Content-Type', content_type+';charset=UTF-8')
+        request.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            request.send_header(k, v)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def __page(self, request, identitykit, content):
+        html = ('<!DOCTYPE html><html><head><meta charset="utf-8"><meta name="identitykit" content="{}">'
+            '<link rel="stylesheet" href="/static/app.css"><script src="/static/app.js"></script></head>'
+            '<body><div class="content">{}</div></body></html>').format(identitykit, content)
+        self.__send(request, 200, html, content_type='text/html')
+
+    def __redirect(self, request, location):
+        self.__send(request, 302, '', {'Location': location})
+
+    # login hops
+
+    def __authorize(self, request, vin, query, data):
+        form = ('<form id="emailPasswordForm" method="POST" action="/signin-service/v1/{}/login/identifier">'
+            '<input type="hidden" name="_csrf" value="mock-csrf">'
+            '<input type="hidden" name="relayState" value="{}">'
+            '<input type="hidden" name="hmac" value="mock-hmac-1">'
+            '<input type="email" name="email"></form>').format(CLIENT, query.get('state', ''))
+        self.__page(request, 'login', form)
+
+    def __identifier(self, request, vin, query, data):
+        idk = ("<script>\nwindow._IDK = {\n  templateModel: {hmac: 'mock-hmac-2', identifierUrl: 'login/identifier', "
+            "postAction: 'login/authenticate', relayState: '"+data.get('relayState', '')+"'},\n  csrf_token: 'mock-csrf'\n}\n</script>")
+        self.__page(request, 'loginAuthenticate', idk)
+
+    def __authenticate(self, request, vin, query, data):
+        if (not data.get('password')):
+            return self.__redirect(request, '/signin-service/v1/{}/login/error?error=login.errors.password_invalid'.format(CLIENT))
+        self.__redirect(request, '/signin-service/v1/callback/success?'+urlencode({'user_id': USER_ID, 'client_id': CLIENT, 'scopes': 'openid profile mbb', 'relayState': data.get('relayState', '')}))
+
+    def __callback(self, request, vin, query, data):
+        self.__redirect(request, 'carnet://identity-kit/login#'+urlencode({'state': query.get('relayState', ''), 'code': 'mock-code', 'access_token': 'mock-access', 'expires_in': '3600', 'token_type': 'bearer', 'id_token': 'mock-id-token'}))
+
+    # tokens
+
+    def __token(self, prefix, ttl=None):
+        token = '{}-{:x}'.format(prefix, self.__rnd.getrandbits(64))
+        with self.__lock:
+            self.__issued[token] = time.time() + (self.token_ttl if ttl is None else ttl)
+        return token
+
+    def __valid(self, token):
+        # only tokens issued by this backend and not yet expired
+        with self.__lock:
+            return self.__issued.get(token, 0) > time.time()
+
+    def __unauthorized(self, request):
+        self.__send(request, 401, {'error': {'errorCode': 'gw.error.authentication', 'description': 'Unauthorized'}})
+
+    def __tokens(self, request, vin, query, data):
+        if (request.path.endswith('/refreshTokens') and not self.__valid(data.get('refresh_token'))):
+            return self.__unauthorized(request)
+        self.__send(request, 200, {'access_token': self.__token('at'), 'id_token': self.__token('it'), 'refresh_token': self.__token('rt', float('inf')), 'expires_in': self.token_ttl, 'token_type': 'bearer'})
+
+    def __register(self, request, vin, query, data):
+        self.__send(request, 200, {'client_id': 'mock-client-id'})
+
+    def __oauth(self, request, vin, query, data):
+        # id_token and refresh_token grants, both send the token in 'token'
+        if (not self.__valid(data.get('token'))):
+            return self.__unauthorized(request)
+        self.__send(request, 200, {'access_token': self.__token('oauth-'+data.get('scope', '')), 'refresh_token': self.__token('ort', float('inf')), 'expires_in': self.token_ttl, 'token_type': 'bearer'})
+
+    # profile
+
+    def __personal_data(self, request, vin, query, data):
+        self.__send(request, 200, {'businessIdentifierValue': 'mock-business-id', 'nickname': 'Mock', 'salutation': 'Hallo', 'firstName': 'Max', 'lastName': 'Mock'})
+
+    def __real_car_data(self, request, vin, query, data):
+        self.__send(request, 200, {'realCars': [{'vehicleIdentificationNumber': v, 'nickname': 'Car '+v[-3:]} for v in self.cars]})
+
+    def __mbb_status(self, request, vin, query, data):
+        self.__send(request, 200, {'profileCompleted': True, 'spinDefined': True, 'carnetEnrollmentCountry': 'DE'})
+
+    def __home_region(self, request, vin, query, data):
+        self.__send(request, 200, {'homeRegion': {'baseUri': {'content': 'http://'+request.headers.get('Host', '')+'/api'}}})
+
+    # S-PIN
+
+    def __pin_requested(self, request, vin, query, data):
+        self.__send(request, 200, {'securityPinAuthInfo': {'securityToken': self.__token('st'), 'securityPinTransmission': {'challenge': '%016X' % self.__rnd.getrandbits(64), 'hashProcedureVersion': 1}}})
+
+    def __pin_completed(self, request, vin, query, data):
+        self.__send(request, 200, {'securityToken': self.__token('secure')})
+
+    # vehicles
+
+    def __vehicles(self, request, vin, query, data):
+        self.__send(request, 200, {'userVehicles': {'vehicle': list(self.cars)}})
+
+    def __vehicle_data(self, request, vin, query, data):
+        self.__send(request, 200, {'vehicleDataDetail': {'vin': vin, 'isConnect': True}})
+
+    def __vsr(self, request, vin, query, data):
+        self.__send(request, 200, self.cars[vin].vsr)
+
+    def __charger(self, request, vin, query, data):
+        car = self.cars[vin]
+        self.__send(request, 200, {'charger': {
+            'settings': {'maxChargeCurrent': value(16)},
+            'status': {
+                'chargingStatusData': {'chargingMode': value('AC' if car.charging else 'invalid'), 'chargingState': value('charging' if car.charging else 'off')},
+                'batteryStatusData': {'stateOfCharge': value(car.soc), 'remainingChargingTime': value(120 if car.charging else 0)},
+                'cruisingRangeStatusData': {'primaryEngineRange': value(car.soc*3)},
+                'plugStatusData': {'plugState': value('connected' if car.charging else 'disconnected'), 'lockState': value('locked' if car.charging else 'unlocked')},
+                }}})
+
+    def __climater(self, request, vin, query, data):
+        car = self.cars[vin]
+        self.__send(request, 200, {'climater': {
+            'settings': {'targetTemperature': value(car.target), 'heaterSource': value('electric')},
+            'status': {
+                'climatisationStatusData': {'climatisationState': value('heating' if car.clima else 'off')},
+                'temperatureStatusData': {'outdoorTemperature': value(2851)},
+                'windowHeatingStatusData': {'windowHeatingStateRear': value('on' if car.window else 'off'), 'windowHeatingStateFront': value('on' if car.window else 'off')},
+                'vehicleParkingClockStatusData': {'vehicleParkingClock': value(TS)},
+                }}})
+
+    def __position(self, request, vin, query, data):
+        car = self.cars[vin]
+        self.__send(request, 200, {'storedPositionResponse': {'parkingTimeUTC': TS, 'position': {'carCoordinate': {'latitude': car.lat, 'longitude': car.lon}, 'heading': {'direction': 90}, 'timestampCarSent': TS, 'timestampTssReceived': TS}}})
+
+    # actions
+
+    def __action(self, request, vin, query, data):
+        self.__send(request, 202, {'action': {'actionId': self.__rnd.randint(1, 10**9), 'actionState': 'queued'}})
+
+    def __charger_action(self, request, vin, query, data):
+        self.cars[vin].charging = data.get('action', {}).get('type') == 'start'
+        self.__action(request, vin, query, data)
+
+    def __climater_action(self, request, vin, query, data):
+        car = self.cars[vin]
+        action = data.get('action', {})
+        if (action.get('type') in ('startClimatisation', 'stopClimatisation')):
+            car.clima = action['type'] == 'startClimatisation'
+        elif (action.get('type') in ('startWindowHeating', 'stopWindowHeating')):
+            car.window = action['type'] == 'startWindowHeating'
+        elif (action.get('type') == 'setSettings'):
+            car.target = int(action['settings']['targetTemperature'])
+        self.__action(request, vin, query, data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the VW WeConnect backend')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--vehicles', type=int, default=1, help='fleet size')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to or taken from the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of vehicle requests answered with 503')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='seconds until issued access tokens expire')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    backend = MockBackend(args.host, args.port, args.vehicles, args.latency, args.jitter, args.error_rate, token_ttl=args.token_ttl).start()
+    print('WECONNECT_BACKEND={}'.format(backend.url))
+    print('vehicles: {}'.format(', '.join(backend.cars)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        backend.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Feb 18 18:20:00 2022
+
+@author: do6uk
+
+Append-only position history: one JSON record per line and a sparse index
+(every INDEX_EVERY records: timestamp and byte offset) in <file>.idx.
+Appending never rewrites the file and a crash can only cut the last line,
+which is dropped on the next open. Files in the former JSON array format
+are migrated on open.
+"""
+import bisect
+import json
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger('VWVehicle')
+
+def load_datetime(s):
+    return datetime.fromisoformat(s.replace('Z','+00:00')).replace(tzinfo=None)
+
+class PositionHistory:
+    INDEX_EVERY = 64
+
+    def __init__(self, file):
+        self.__file = file
+        self.__index_file = file+'.idx'
+        self.__index_ts = []
+        self.__index_offsets = []
+        self.__count = 0
+        self.__open()
+
+    def __open(self):
+        if (not os.path.exists(self.__file)):
+            self.__write_index([])
+            return
+        with open(self.__file, 'rb') as f:
+            head = f.read(1)
+        if (head == b'['):
+            self.migrate()
+            return
+        self.__repair()
+        self.__load_index()
+
+    def __repair(self):
+        # drops a partly written last line
+        size = os.path.getsize(self.__file)
+        if (size == 0):
+            return
+        with open(self.__file, 'rb+') as f:
+            f.seek(size-1)
+            if (f.read(1) == b'\n'):
+                return
+            pos = size-1
+            while (pos > 0):
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                nl = chunk.rfind(b'\n')
+                if (nl >= 0):
+                    pos += nl+1
+                    break
+            logger.warning('Dropping incomplete last record of {}'.format(self.__file))
+            f.truncate(pos)
+
+    def __load_index(self):
+        try:
+            with open(self.__index_file) as f:
+                for line in f:
+                    e = json.loads(line)
+                    self.__index_ts.append(load_datetime(e['timestamp']))
+                    self.__index_offsets.append(e['offset'])
+                    self.__count = e['count']
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            logger.info('Rebuilding index of {}'.format(self.__file))
+            self.__rebuild_index()
+            return
+        # count and index the records after the last indexed one
+        last = self.__index_offsets[-1] if self.__index_offsets else -1
+        offset = max(last, 0)
+        self.__count = max(self.__count-1, 0)
+        with open(self.__file, 'rb') as f:
+            f.seek(offset)
+            for line in iter(f.readline, b''):
+                self.__count += 1
+                if (offset > last and (self.__count-1) % self.INDEX_EVERY == 0):
+                    self.__add_index(json.loads(line)['timestamp'], offset)
+                offset += len(line)
+
+    def __rebuild_index(self):
+        self.__index_ts = []
+        self.__index_offsets = []
+        self.__count = 0
+        self.__write_index([])
+        offset = 0
+        with open(self.__file, 'rb') as f:
+            for line in iter(f.readline, b''):
+                self.__count += 1
+                if ((self.__count-1) % self.INDEX_EVERY == 0):
+                    self.__add_index(json.loads(line)['timestamp'], offset)
+                offset += len(line)
+
+    def __write_index(self, entries):
+        with open(self.__index_file, 'w') as f:
+            for e in entries:
+                f.write(json.dumps(e)+'\n')
+
+    def __add_index(self, timestamp, offset):
+        self.__index_ts.append(load_datetime(timestamp))
+        self.__index_offsets.append(offset)
+        with open(self.__index_file, 'a') as f:
+            f.write(json.dumps({'timestamp': timestamp, 'offset': offset, 'count': self.__count})+'\n')
+
+    def migrate(self):
+        # converts a file in the former JSON array format
+        with open(self.__file) as f:
+            data = json.load(f)
+        tmp = self.__file+'.tmp'
+        with open(tmp, 'w') as f:
+            for rec in data:
+                f.write(json.dumps(rec)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.__file)
+        logger.info('Migrated {} records of {} to line format'.format(len(data), self.__file))
+        self.__rebuild_index()
+
+    def append(self, timestamp, latitude, longitude):
+        rec = {'timestamp': timestamp.isoformat(), 'coordinates': {'latitude': latitude, 'longitude': longitude}}
+        line = (json.dumps(rec)+'\n').encode()
+        with open(self.__file, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__count += 1
+        if ((self.__count-1) % self.INDEX_EVERY == 0):
+            self.__add_index(rec['timestamp'], offset)
+
+    def latest(self):
+        # last record without reading the file from the start
+        if (self.__count == 0):
+            return None
+        with open(self.__file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = pos = f.tell()
+            tail = b''
+            while (pos > 0 and tail.count(b'\n') < 2):
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                tail = f.read(end-pos)
+        return self.__record(tail.rstrip(b'\n').rsplit(b'\n', 1)[-1])
+
+    def range(self, start=None, end=None):
+        # records with start <= timestamp <= end, reading from the index entry before start
+        offset = 0
+        if (start is not None):
+            i = bisect.bisect_right(self.__index_ts, start)-1
+            if (i >= 0):
+                offset = self.__index_offsets[i]
+        result = []
+        with open(self.__file, 'rb') as f:
+            f.seek(offset)
+            for line in iter(f.readline, b''):
+                rec = self.__record(line)
+                if (start is not None and rec['timestamp'] < start):
+                    continue
+                if (end is not None and rec['timestamp'] > end):
+                    break
+                result.append(rec)
+        return result
+
+    def __record(self, line):
+        rec = json.loads(line)
+        rec['timestamp'] = load_datetime(rec['timestamp'])
+        return rec
+
+    def __len__(self):
+        return self.__count
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Feb 20 11:15:00 2022
+
+@author: do6uk
+
+Token bucket for request budgets: `rate` tokens per second, at most `capacity` stored.
+RateLimiter combines one bucket for the account with one bucket per host,
+retry_delay() is the backoff between retries of a throttled or failed request.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __fill(self, now):
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    def try_acquire(self, n=1):
+        with self.__lock:
+            self.__fill(time.monotonic())
+            if (self.__tokens >= n):
+                self.__tokens -= n
+                return True
+            return False
+
+    def wait_time(self, n=1):
+        # seconds until n tokens are available
+        with self.__lock:
+            self.__fill(time.monotonic())
+            if (self.__tokens >= n):
+                return 0
+            return (n - self.__tokens) / self.rate
+
+    def acquire(self, n=1, timeout=None):
+        # blocks until n tokens are taken, False if timeout is over first
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if (self.try_acquire(n)):
+                return True
+            wait = self.wait_time(n)
+            if (deadline is not None and time.monotonic() + wait > deadline):
+                return False
+            time.sleep(wait)
+
+class RateLimiter():
+
+    def __init__(self, rate, burst, host_rate, host_burst):
+        self.__account = TokenBucket(rate, burst)
+        self.__host_rate = host_rate
+        self.__host_burst = host_burst
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+
+    def __host(self, host):
+        with self.__lock:
+            if (host not in self.__hosts):
+                self.__hosts[host] = TokenBucket(self.__host_rate, self.__host_burst)
+            return self.__hosts[host]
+
+    def acquire(self, host):
+        # blocks until the host and the account allow one more request, True if it had to wait
+        bucket = self.__host(host)
+        waited = False
+        if (not bucket.try_acquire()):
+            waited = bucket.acquire()
+        if (not self.__account.try_acquire()):
+            waited = self.__account.acquire()
+        return waited
+
+    async def acquire_async(self, host):
+        # acquire() for asyncio: the same buckets, waiting does not block the event loop
+        import asyncio
+        waited = False
+        for bucket in (self.__host(host), self.__account):
+            while (not bucket.try_acquire()):
+                waited = True
+                await asyncio.sleep(bucket.wait_time())
+        return waited
+
+def retry_delay(attempt, retry_after=None, base=1, cap=60):
+    # Retry-After (seconds or HTTP date) if the server sent one, else exponential backoff with full jitter
+    if (retry_after):
+        try:
+            return min(cap, max(0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            return min(cap, max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(cap, base * 2 ** (attempt-1)))
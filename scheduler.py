@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+@name:		scheduler
+@date:		2022-02-20
+@author:	do6uk
+
+Polling scheduler for weconnectMQTT: every car is polled on its own interval
+The interval comes from a function of the car-state (e.g. shorter while charging),
+is jittered to spread the requests and an account-wide budget limits the polls
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('weconnectMQTT')
+
+class PollScheduler:
+
+	def __init__(self, interval, budget=None, jitter=0.1):
+		# interval: function(key) -> seconds, budget: TokenBucket with one token per poll
+		self.__interval = interval
+		self.__budget = budget
+		self.__jitter = jitter
+		self.__heap = []
+		self.__when = {}	# key -> time of its valid heap entry, older entries are skipped
+		self.__lock = threading.Lock()
+
+	def __next(self, key, now):
+		return now + self.__interval(key) * (1 + random.uniform(-self.__jitter, self.__jitter))
+
+	def add(self, key, now=None):
+		# first poll at a random point of the first interval, so cars do not start together
+		now = time.time() if now is None else now
+		with self.__lock:
+			if key in self.__when:
+				return
+			self.__when[key] = now + self.__interval(key) * random.random()
+			heapq.heappush(self.__heap, (self.__when[key], key))
+
+	def remove(self, key):
+		with self.__lock:
+			self.__when.pop(key, None)
+
+	def reschedule(self, key, now=None):
+		# next poll one interval from now, with the interval of the current car-state (after a poll or a command)
+		now = time.time() if now is None else now
+		with self.__lock:
+			if key not in self.__when:
+				return
+			self.__when[key] = self.__next(key, now)
+			heapq.heappush(self.__heap, (self.__when[key], key))
+
+	def due(self, now=None):
+		# keys to poll now, each one is rescheduled for its next interval
+		now = time.time() if now is None else now
+		result = []
+		with self.__lock:
+			while self.__heap and self.__heap[0][0] <= now:
+				when, key = heapq.heappop(self.__heap)
+				if self.__when.get(key) != when:
+					continue
+				if self.__budget and not self.__budget.try_acquire():
+					wait = self.__budget.wait_time()
+					logger.debug('SCHEDULER budget exhausted - {} delayed by {:.0f}s'.format(key,wait))
+					self.__when[key] = now + wait
+					heapq.heappush(self.__heap, (self.__when[key], key))
+					break
+				result.append(key)
+				# until the poll calls reschedule() with the new state
+				self.__when[key] = self.__next(key, now)
+				heapq.heappush(self.__heap, (self.__when[key], key))
+		return result
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Feb 19 16:40:00 2022
+
+@author: do6uk
+
+Local time-series store for vsr, charger and climater samples.
+Each metric of a vehicle keeps its samples in time-partitioned segments of two
+array('d') columns (timestamps, values). Segments older than RAW_RETENTION are
+downsampled to BUCKET averages, downsampled data older than RETENTION is dropped,
+so memory stays bounded for many vehicles.
+Samples are stamped with the capture time of the backend, a value polled again
+without a new capture is stored only once.
+"""
+import base64
+import bisect
+import calendar
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from vsr import dk_to_celsius
+
+logger = logging.getLogger('API')
+
+def dig(j, *path):
+    for p in path:
+        if (not isinstance(j, dict) or p not in j):
+            return None
+        j = j[p]
+    return j
+
+def number(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+def epoch(ts):
+    # UTC timestamp of the backend ('2022-02-23T20:00:00Z') as seconds or None
+    try:
+        return float(calendar.timegm(time.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S')))
+    except (TypeError, ValueError):
+        return None
+
+class Series:
+    # samples of one metric: segment start -> (timestamps, values)
+    __slots__ = ('raw', 'down')
+
+    def __init__(self):
+        self.raw = {}
+        self.down = {}
+
+class TelemetryStore:
+    SEGMENT = 3600
+    RAW_RETENTION = 24*3600
+    BUCKET = 300
+    RETENTION = 30*24*3600
+
+    # metrics taken from the responses: name -> path
+    VSR_GROUPS = ('status', 'tyre_pressure')
+    CHARGER_METRICS = {
+        'charger.state_of_charge': ('charger', 'status', 'batteryStatusData', 'stateOfCharge', 'content'),
+        'charger.remaining_charging_time': ('charger', 'status', 'batteryStatusData', 'remainingChargingTime', 'content'),
+        'charger.primary_range': ('charger', 'status', 'cruisingRangeStatusData', 'primaryEngineRange', 'content'),
+        }
+    CLIMATER_METRICS = {
+        'climater.temperature_target': ('climater', 'settings', 'targetTemperature', 'content'),
+        'climater.temperature_outside': ('climater', 'status', 'temperatureStatusData', 'outdoorTemperature', 'content'),
+        }
+
+    def __init__(self):
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def add(self, vin, metric, value, ts=None):
+        if (value is None):
+            return
+        ts = time.time() if ts is None else ts
+        seg = int(ts // self.SEGMENT) * self.SEGMENT
+        with self.__lock:
+            series = self.__series.get((vin, metric))
+            if (series is None):
+                series = self.__series[(vin, metric)] = Series()
+            if (seg in series.down):
+                return # already downsampled, e.g. the unchanged capture time of a car parked for days
+            if (seg not in series.raw):
+                series.raw[seg] = (array('d'), array('d'))
+            tss, vals = series.raw[seg]
+            if (tss and ts <= tss[-1]):
+                i = bisect.bisect_right(tss, ts)
+                if (i and tss[i-1] == ts):
+                    return
+                tss.insert(i, ts)
+                vals.insert(i, value)
+            else:
+                tss.append(ts)
+                vals.append(value)
+
+    def record_vsr(self, vin, rec, ts=None):
+        # rec: VSRRecord of VSR.parse_typed(), values are stamped with tsCarCaptured, ts is the fallback
+        for group in self.VSR_GROUPS:
+            for name, value in rec.as_dict().get(group, {}).items():
+                if (isinstance(value, (int, float))):
+                    self.add(vin, group+'.'+name, float(value), epoch(rec.captured_at(group, name)) or ts)
+
+    def record_charger(self, vin, charger, ts=None):
+        # values are stamped with their 'timestamp', ts is the fallback
+        for metric, path in self.CHARGER_METRICS.items():
+            self.add(vin, metric, number(dig(charger, *path)), epoch(dig(charger, *path[:-1], 'timestamp')) or ts)
+
+    def record_climater(self, vin, climater, ts=None):
+        for metric, path in self.CLIMATER_METRICS.items():
+            dk = number(dig(climater, *path))
+            self.add(vin, metric, None if dk is None else dk_to_celsius(dk), epoch(dig(climater, *path[:-1], 'timestamp')) or ts)
+
+    def range(self, vin, metric, start=None, end=None):
+        # [(timestamp, value)] with start <= timestamp <= end, downsampled data first
+        with self.__lock:
+            series = self.__series.get((vin, metric))
+            if (series is None):
+                return []
+            segments = sorted(list(series.down.items()) + list(series.raw.items()))
+            result = []
+            for seg, (tss, vals) in segments:
+                if ((end is not None and seg > end) or (start is not None and seg + self.SEGMENT <= start)):
+                    continue
+                i = 0 if start is None else bisect.bisect_left(tss, start)
+                j = len(tss) if end is None else bisect.bisect_right(tss, end)
+                result.extend(zip(tss[i:j], vals[i:j]))
+        return result
+
+    def latest(self, vin, metric):
+        with self.__lock:
+            series = self.__series.get((vin, metric))
+            if (series is None or not series.raw):
+                return None
+            tss, vals = series.raw[max(series.raw)]
+            return (tss[-1], vals[-1])
+
+    def metrics(self, vin=None):
+        with self.__lock:
+            return sorted(m for v, m in self.__series if vin is None or v == vin)
+
+    def compact(self, now=None):
+        # downsamples old raw segments and drops expired ones
+        now = time.time() if now is None else now
+        with self.__lock:
+            for series in self.__series.values():
+                for seg in [s for s in series.raw if s + self.SEGMENT <= now - self.RAW_RETENTION]:
+                    tss, vals = series.raw.pop(seg)
+                    buckets = {}
+                    for t, v in zip(tss, vals):
+                        b = buckets.setdefault(int(t // self.BUCKET) * self.BUCKET, [0.0, 0])
+                        b[0] += v
+                        b[1] += 1
+                    series.down[seg] = (array('d', sorted(buckets)), array('d', [buckets[b][0]/buckets[b][1] for b in sorted(buckets)]))
+                for seg in [s for s in series.down if s + self.SEGMENT <= now - self.RETENTION]:
+                    del series.down[seg]
+
+    def save(self, file):
+        def pack(segments):
+            return {str(seg): [base64.b64encode(tss.tobytes()).decode(), base64.b64encode(vals.tobytes()).decode()] for seg, (tss, vals) in segments.items()}
+        with self.__lock:
+            d = [{'vin': vin, 'metric': metric, 'raw': pack(s.raw), 'down': pack(s.down)} for (vin, metric), s in self.__series.items()]
+        tmp = file+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f)
+        os.replace(tmp, file)
+        logger.info('Saved telemetry of %d series', len(d))
+
+    def load(self, file):
+        def unpack(segments):
+            r = {}
+            for seg, (tss, vals) in segments.items():
+                r[int(seg)] = (array('d'), array('d'))
+                r[int(seg)][0].frombytes(base64.b64decode(tss))
+                r[int(seg)][1].frombytes(base64.b64decode(vals))
+            return r
+        try:
+            with open(file) as f:
+                d = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            logger.info('Telemetry file not found')
+            return
+        with self.__lock:
+            for e in d:
+                s = Series()
+                s.raw = unpack(e['raw'])
+                s.down = unpack(e['down'])
+                self.__series[(e['vin'], e['metric'])] = s
+        logger.info('Loaded telemetry of %d series', len(d))
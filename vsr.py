@@ -8,6 +8,46 @@ Created on Mon Jun 28 00:08:42 2021
 """
 
 import logging
+import time
+
+def dk_to_celsius(v):
+    # temperatures of the backend are in deci-Kelvin, converted as the bridge always did (/10-273)
+    return round(v/10-273, 1)
+
+class VSRRecord:
+    # typed vsr of one vehicle: numeric values, units and capture times in lists indexed by the slot of each field
+    __slots__ = ('vin', 'values', 'units', 'captured', '_slots')
+
+    def __init__(self, vin, slots):
+        self.vin = vin
+        self.values = [None]*len(slots)
+        self.units = [None]*len(slots)
+        self.captured = [None]*len(slots)
+        self._slots = slots
+
+    def __getitem__(self, key):
+        v = self.values[self._slots[key]]
+        if (v is None):
+            raise KeyError(key)
+        return v
+
+    def get(self, group, name, default=None):
+        v = self.values[self._slots[(group, name)]]
+        return default if v is None else v
+
+    def unit(self, group, name):
+        return self.units[self._slots[(group, name)]]
+
+    def captured_at(self, group, name):
+        # tsCarCaptured of the value as sent by the backend, e.g. '2022-02-23T20:00:00Z'
+        return self.captured[self._slots[(group, name)]]
+
+    def as_dict(self):
+        rr = {'vin': self.vin}
+        for (group, name), i in self._slots.items():
+            if (self.values[i] is not None):
+                rr.setdefault(group, {})[name] = self.values[i]
+        return rr
 
 class VSR:
     __vsr_fields = [
@@ -92,57 +132,100 @@ class VSR:
         ('0x0301FFFFFF', '0x030106000D', 'tyre_pressure', 'difference_right_front'),
         ('0x0301FFFFFF', '0x030106000E', 'tyre_pressure', 'difference_right_rear'),
         ('0x0301FFFFFF', '0x030106000F', 'tyre_pressure', 'difference_spare'),
-        ('0x0301FFFFFF', '0x0301060001', 'tyre_pressure', 'current_left_front'),
-        ('0x0301FFFFFF', '0x0301060002', 'tyre_pressure', 'desired_left_front'),
-        ('0x0301FFFFFF', '0x0301060003', 'tyre_pressure', 'current_left_rear'),
-        ('0x0301FFFFFF', '0x0301060004', 'tyre_pressure', 'desired_left_rear'),
-        ('0x0301FFFFFF', '0x0301060005', 'tyre_pressure', 'current_right_front'),
-        ('0x0301FFFFFF', '0x0301060006', 'tyre_pressure', 'desired_right_front'),
-        ('0x0301FFFFFF', '0x0301060007', 'tyre_pressure', 'current_right_rear'),
-        ('0x0301FFFFFF', '0x0301060008', 'tyre_pressure', 'desired_right_rear'),
-        ('0x0301FFFFFF', '0x0301060009', 'tyre_pressure', 'current_spare'),
-        ('0x0301FFFFFF', '0x030106000A', 'tyre_pressure', 'desired_spare'),
-        ('0x0301FFFFFF', '0x030106000B', 'tyre_pressure', 'difference_left_front'),
-        ('0x0301FFFFFF', '0x030106000C', 'tyre_pressure', 'difference_left_rear'),
-        ('0x0301FFFFFF', '0x030106000D', 'tyre_pressure', 'difference_right_front'),
-        ('0x0301FFFFFF', '0x030106000E', 'tyre_pressure', 'difference_right_rear'),
         
         ]
-    
+
+    # field id -> (group, name, value mapping or None, slot in VSRRecord), compiled once at import
+    __vsr_index = {e[1]: (e[2], e[3], e[4] if len(e) == 5 else None, i) for i, e in enumerate(__vsr_fields)}
+    __vsr_slots = {(e[2], e[3]): i for i, e in enumerate(__vsr_fields)}
+
+    # unit conversions of the typed mode: unit -> (new unit, function)
+    __vsr_units = {
+        'dK': ('degC', dk_to_celsius),
+        }
+
+    # unknown fields are logged once per WARN_INTERVAL seconds and field id
+    WARN_INTERVAL = 3600
+    __warned = {}
+
     def __init__(self):
         pass
-    
+
+    def __warn_unknown(self, d, f):
+        now = time.time()
+        if (now - self.__warned.get(f['id'], -self.WARN_INTERVAL) < self.WARN_INTERVAL):
+            return
+        VSR.__warned[f['id']] = now
+        logging.warning('[parse_vsr] item %s, field %s not found', d['id'],f['id'])
+        logging.warning('[parse_vsr] %s', f)
+
     def parse(self, j):
-        r = {}
         rr = {}
         if ('StoredVehicleDataResponse' in j):
             j = j['StoredVehicleDataResponse']
-            r['VehicleDataResponse'] = {}
             rr['vin'] = j['vin']
             if ('vehicleData' in j and 'data' in j['vehicleData']):
+                index = self.__vsr_index
                 for d in j['vehicleData']['data']:
                     if ('id' in d and 'field' in d):
                         for f in d['field']:
-                            found = False
-                            for e in self.__vsr_fields:
-                                if (e[1] == f['id']):
-                                    if (e[2] not in rr):
-                                        rr[e[2]] = {}
-                                    rr[e[2]][e[3]] = 'null'
-                                    if ('value' in f):
-                                        if (len(e) == 5 and f['value'] in e[4]):
-                                            rr[e[2]][e[3]] = e[4][f['value']]
-                                        else:
-                                            rr[e[2]][e[3]] = f['value'] if f['value'] else 'null'
-                                    if ('unit' in f):
-                                        rr[e[2]][e[3]] += ' '+f['unit']
-                                    #if ('textId' in f):
-                                    #    rr[e[2]][e[3]] += ' ({})'.format(f['textId'])
-                                    found = True
-                                    break
-                            if (not found):
-                                logging.warning('[parse_vsr] item %s, field %s not found', d['id'],f['id'])
-                                logging.warning('[parse_vsr] %s', f)
+                            e = index.get(f['id'])
+                            if (e is None):
+                                self.__warn_unknown(d, f)
+                                continue
+                            group, name, mapping, slot = e
+                            if (group not in rr):
+                                rr[group] = {}
+                            v = 'null'
+                            if ('value' in f):
+                                if (mapping and f['value'] in mapping):
+                                    v = mapping[f['value']]
+                                else:
+                                    v = f['value'] if f['value'] else 'null'
+                            if ('unit' in f):
+                                v += ' '+f['unit']
+                            rr[group][name] = v
         return rr
-        
-        
\ No newline at end of file
+
+    def parse_typed(self, j):
+        if ('StoredVehicleDataResponse' not in j):
+            return None
+        j = j['StoredVehicleDataResponse']
+        rec = VSRRecord(j['vin'], self.__vsr_slots)
+        if ('vehicleData' in j and 'data' in j['vehicleData']):
+            index = self.__vsr_index
+            units = self.__vsr_units
+            for d in j['vehicleData']['data']:
+                if ('id' in d and 'field' in d):
+                    for f in d['field']:
+                        e = index.get(f['id'])
+                        if (e is None):
+                            self.__warn_unknown(d, f)
+                            continue
+                        mapping, slot = e[2], e[3]
+                        v = f.get('value')
+                        if (not v):
+                            continue
+                        rec.captured[slot] = f.get('tsCarCaptured')
+                        if (mapping and v in mapping):
+                            rec.values[slot] = mapping[v]
+                            continue
+                        try:
+                            v = int(v)
+                        except ValueError:
+                            try:
+                                v = float(v)
+                            except ValueError:
+                                pass
+                        unit = f.get('unit')
+                        if (unit in units and not isinstance(v, str)):
+                            unit, conv = units[unit]
+                            v = conv(v)
+                        rec.values[slot] = v
+                        rec.units[slot] = unit
+        return rec
+
+    def parse_many(self, docs, typed=False):
+        if (typed):
+            return [self.parse_typed(j) for j in docs]
+        return [self.parse(j) for j in docs]
@@ -26,18 +26,51 @@ mqtt_broker = 'localhost'
 mqtt_port = 1883
 mqtt_base_topic = '/weconnectMQTT/'
 mqtt_alive = 15		# interval in seconds to send alive-message via MQTT
+mqtt_workers = 4	# number of parallel workers handling MQTT-commands (commands for the same car run in order)
+mqtt_changes_only = True	# publish car-values only if they changed ...
+mqtt_full_refresh = 3600	# ... or the last publish is older than this (seconds)
+mqtt_state_json = False	# publish all values of a car as one retained JSON document to <car-topic>/json after each request
+mqtt_leaf_topics = True	# publish each value to its own topic (can be switched off if mqtt_state_json is used)
+mqtt_metrics = 300	# interval in seconds to publish latency and errors of the WeConnect requests as JSON to service/metrics, 0 to disable
+metrics_port = None	# serve the request metrics for Prometheus on http://<metrics_host>:<port>/metrics, e.g. 9120 (9100 is node_exporter)
+metrics_host = '127.0.0.1'	# '' to serve the metrics on all interfaces
+vwc_cache = True	# keep rarely changing data (roles, configurations, profile) in memory, vehicle data with isConnect is always fetched
+geocode_file = 'weconnectMQTT.geocache'	# addresses of known parking positions, None to keep them in memory only
+telemetry_enabled = True	# keep a local history of SoC, range, temperatures and tyre pressures
+telemetry_file = 'weconnectMQTT.telemetry'	# history is saved here when the service stops, None to keep it in memory only
+telemetry_save = 900	# interval in seconds to save the history while the service runs
+
+# Step 4: fullstate-requests
+fullstate_concurrent = True	# fetch all data of all cars at the same time instead of one after another
+fullstate_limit_account = 8	# max. parallel requests to WeConnect for your account
+fullstate_limit_host = 4	# max. parallel requests to one home-region server (requests per second are limited by WeConnect.RATE_LIMIT/HOST_RATE_LIMIT)
+
+# Step 5: polling in service mode
+poll_enabled = True	# fetch the fullstate of each car regularly, not only at startup and on get/*-requests
+poll_interval_active = 300	# seconds between polls while the car is charging or climatisation is on
+poll_interval_idle = 1800	# seconds between polls while the car is parked and idle
+poll_jitter = 0.1	# intervals vary randomly by this part, so the cars are not polled at the same time
+poll_budget = 24	# max. polls per hour for all cars of your account (one poll = 5 requests)
 
 
 ## IMPORTS
 
 from NativeAPI import WeConnect
+from dispatcher import Dispatcher
+from geocode import Geocoder
+from ratelimit import TokenBucket
+from scheduler import PollScheduler
+from telemetry import TelemetryStore
+from vsr import dk_to_celsius
 import logging
-import requests
 import time,sys,random,json
 import paho.mqtt.client as mqtt
 import argparse
 import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from urllib.parse import urlparse
 
 
 ## DEFAULTS & GLOBAL VARS
@@ -46,6 +79,22 @@ state_dict = {'0': 0, '1': 1,'off': 0,'on': 1,'connected': 1,'disconnected': 0,'
 state_string = {'0': 'off', '1': 'on', 0: 'off', 1: 'on', 'on': 'on', 'off': 'off'}
 
 lastrun = 0
+lastmetrics = 0
+lastsave = 0
+vwc = None
+vwc_lock = threading.Lock()
+dispatcher = None	# built with the other workers in build_runtime(), once the config is final
+car_actions = ('set/flash','set/honk','set/clima','set/climatemp','set/window','set/charger','get/charger','get/position','get/clima','get/state','get/fullstate')
+routes = {}	# MQTT-topic -> (car, action), see build_routes()
+published = {}	# topic -> (value, time) of the last publish
+published_lock = threading.Lock()
+car_docs = {}	# car-topic -> section -> key -> {'value','time'} for mqtt_state_json
+geocoder = None
+telemetry = None
+fullstate_pool = None
+limit_account = None
+limit_hosts = {}
+limit_lock = threading.Lock()
 verbose = False
 log_stream = False
 mqtt_bridge = True
@@ -55,71 +104,38 @@ service_log_level = logging.WARN	#level in SERVICE-Mode
 
 version = '20211230.1'
 
-## ARGUMENT
-
-parser = argparse.ArgumentParser(description='weconnectMQTT verbindet die VW WeConnect API mit einem MQTT-Broker und bietet ein kleines Shell-Interface')
-parser.add_argument('--version', action='store_true',help='zeigt dies Versionsinfo')
-parser.add_argument('--verbose', action='store_true',help='Ausgabe der Daten in lesbarer Form')
-parser.add_argument('--info', action='store_true',help='Ausgabe von Meldungen aus dem internen Logger')
-parser.add_argument('--debug', action='store_true',help='Ausgabe aller Meldungen aus dem internen Logger')
-parser.add_argument('--profile', action='store_true',help='Anzeige WeConnect-Profildaten')
-parser.add_argument('--state', action='store_true',help='Abruf kurzer Status *kann mit vin/plate/name kombiniert werden')
-parser.add_argument('--fullstate', action='store_true',help='Abruf langer Status *kann mit vin/plate/name kombiniert werden')
-parser.add_argument('--service', action='store_true',help='aktivieren der MQTT-Bridge als Service')
-parser.add_argument('--vin', default=False,help='Auswahl des Fahrzeugs per FIN (XXX...123) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
-parser.add_argument('--plate', default=False,help='Auswahl des Fahrzeugs per Kennzeichen (XXX-YY1234) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
-parser.add_argument('--name', default=False,help='Auswahl des Fahrzeugs per Name (ABC) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
-parser.add_argument('--charger',help='schalte Ladung (1|0 oder on|off)')
-parser.add_argument('--clima',help='schalte Klimatisierung (1|0 oder on|off)')
-parser.add_argument('--climatemp',help='setze Solltemperatur in Grad-C (XX.X)')
-parser.add_argument('--window',help='schalte Scheibenheizung (1|0 oder on|off)')
-parser.add_argument('--honk',help='aktiviere Hupe (1|0 oder on|off)')
-parser.add_argument('--flash',help='aktiviere Blinker (1|0 oder on|off)')
-args = vars(parser.parse_args())
-
-if args['verbose'] or args['debug'] or args['version']:
-	print('\nweconnectMQTT Version {}\n'.format(version))
-	if args['version']:
-		sys.exit()
-
-if args['profile'] or args['fullstate'] or args['state'] or args['verbose']:
-	verbose = True
-	log_stream = True
-	log_level = cli_log_level
-
-if args['service']:
-	log_stream = True
-	log_level = service_log_level
-
-if args['info']:
-	log_stream = True
-	log_level = logging.INFO
-
-if args['debug']:
-	log_stream = True
-	log_level = logging.DEBUG
-
-logger = logging.getLogger('weconnectMQTT')
-logger.setLevel(log_level)
-logger.propagate = False
+def poll_interval(vin):
+	car = car_by('vin',vin)
+	if car and (car.get('charging') or car.get('clima')):
+		return poll_interval_active
+	return poll_interval_idle
 
-logformat = logging.Formatter('%(asctime)s %(levelname)s\t%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-console_log = logging.StreamHandler()
-console_log.setFormatter(logformat)
-console_log.setLevel(log_level)
-logger.addHandler(console_log)
+poller = None
 
-logger.debug('weconnectMQTT {} pre-initialized'.format(version))
+logger = logging.getLogger('weconnectMQTT')
+mclient = None
+mconnect = 0
+args = {}
 
 ## FUNCTIONS
 
+def build_runtime():
+	# workers, caches and schedulers from the config above, called by main() after the arguments are parsed
+	global dispatcher, geocoder, telemetry, fullstate_pool, limit_account, poller
+	dispatcher = Dispatcher(mqtt_workers)
+	geocoder = Geocoder(file=geocode_file)
+	telemetry = TelemetryStore() if telemetry_enabled else None
+	fullstate_pool = ThreadPoolExecutor(max_workers=fullstate_limit_account, thread_name_prefix='fullstate')
+	limit_account = threading.BoundedSemaphore(fullstate_limit_account)
+	limit_hosts.clear()
+	poller = PollScheduler(poll_interval, TokenBucket(poll_budget/3600, max(1,len(mycars))), poll_jitter)
+
 def car_by(item, value):
 	global mycars
 	for car in mycars:
 		if car[item] == value:
 			return car
-		else:
-			return False
+	return False
 
 def car_savepos(vin, lat, lon):
 	global mycars
@@ -148,104 +164,190 @@ def state_conv(msg):
 	except:
 		return msg
 
+def car_publish(car, subtopic, value, qos=0, force=False, ts=None):
+	# publishes a value of a car, unchanged values are skipped until mqtt_full_refresh is over
+	# force is for events (ok, error, offline): published every time, even if unchanged
+	# ts is the timestamp of the value from the backend, kept in the JSON document next to the publish time
+	topic = mqtt_base_topic+car['topic']+'/'+subtopic
+	now = time.time()
+	if mqtt_state_json:
+		section, _, key = subtopic.partition('/')
+		entry = {'value': value, 'time': datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')}
+		if ts:
+			entry['timestamp'] = ts
+		with published_lock:
+			car_docs.setdefault(car['topic'], {}).setdefault(section, {})[key if key else 'state'] = entry
+		if not mqtt_leaf_topics:
+			return False
+	if mqtt_changes_only:
+		with published_lock:
+			last = published.get(topic)
+			if not force and last and last[0] == value and now-last[1] < mqtt_full_refresh:
+				return False
+			published[topic] = (value, now)
+	mclient.publish(topic, value, qos)
+	return True
+
+def car_state_publish(car=False):
+	# publishes the merged state of the car (or all cars) as one retained JSON document
+	if not mqtt_state_json or not mconnect:
+		return
+	for c in ([car] if car else mycars):
+		with published_lock:
+			doc = car_docs.get(c['topic'])
+			if not doc:
+				continue
+			doc = json.dumps({'vin': c['vin'], 'name': c['name'], 'state': doc})
+		mclient.publish(mqtt_base_topic+c['topic']+'/json', doc, 1, retain=True)
+		logger.debug('MQTT published state document of {}'.format(c['name']))
+
+def car_snapshot_clear(car=False):
+	# next publish of the car (or all cars) is a full one
+	with published_lock:
+		if not car:
+			published.clear()
+			return
+		prefix = mqtt_base_topic+car['topic']+'/'
+		for topic in [t for t in published if t.startswith(prefix)]:
+			del published[topic]
+
+def vwc_client():
+	# one WeConnect-client for the whole process: session and tokens stay in memory, connections stay warm
+	# login() only checks the tokens and refreshes them if expired
+	global vwc
+	with vwc_lock:
+		if vwc is None:
+			logger.debug('VWC creating shared client ...')
+			vwc = WeConnect()
+			if vwc_cache:
+				vwc.enable_cache({'vehicledata': 0})
+		vwc.login()
+	return vwc
+
 def on_message(client, userdata, message):
-	global mqtt_bridge,mycars
+	# runs in the paho network-thread: only decode and enqueue, the commands are handled by the dispatcher-workers
+	global mqtt_bridge
 
 	topic = message.topic
 	payload = str(message.payload.decode("utf-8"))
 	logger.debug('MQTT MSG HANDLE Topic: {} Payload: {}'.format(topic,payload))
 
-	if mconnect:
-		mclient.publish(mqtt_base_topic+'active',1)
+	if topic == mqtt_base_topic+'set/service':
+		logger.info('MQTT SET Service > {}'.format(payload))
+		if verbose:
+			print('\nSET MQTT Service',payload)
+		mqtt_bridge = bool(state_conv(payload))
+		if not mqtt_bridge:
+			logger.warn('MQTT Service stopping - requested from MQTT!')
+		mclient.publish(mqtt_base_topic+'service/response',True)
+		return
 
+	route = routes.get(topic)
+	if route is None:
+		logger.debug('MQTT MSG HANDLE no route for {}'.format(topic))
+		return
+	car, action = route
+	if car:
+		dispatcher.submit(car['vin'], handle_message, car, action, payload)
+		return
+	# get/state and get/fullstate of all cars: one job per car, queued behind the commands of that car
+	for car in mycars:
+		if car['active']:
+			dispatcher.submit(car['vin'], handle_message, car, action, payload)
+
+def build_routes():
+	# topic -> (car, action), rebuild after changing mycars
+	global routes
+	new_routes = {}
 	for car in mycars:
 		if not car['active']: continue
-		if topic == mqtt_base_topic+car['topic']+'/set/flash':
+		for action in car_actions:
+			new_routes[mqtt_base_topic+car['topic']+'/'+action] = (car, action)
+	for action in ('get/state','get/fullstate'):
+		new_routes[mqtt_base_topic+action] = (False, action)
+	routes = new_routes
+	logger.debug('MQTT routes built for {} topics'.format(len(routes)))
+
+def handle_message(car, action, payload):
+	# runs in a dispatcher-worker, commands for the same car are handled in order of arrival
+	if mconnect:
+		mclient.publish(mqtt_base_topic+'active',1)
+
+	if car:
+		if action == 'set/flash':
 			logger.info('MQTT SET Flash > {}'.format(payload))
 			if verbose:
 				print('\nSET Blinker',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/flash',do_flash(car['vin']))
 
-		if topic == mqtt_base_topic+car['topic']+'/set/honk':
+		if action == 'set/honk':
 			logger.info('MQTT SET Honk > {}'.format(payload))
 			if verbose:
 				print('\nSET Hupe',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/honk',do_honk(car['vin'],int(payload)))
 
-		if topic == mqtt_base_topic+car['topic']+'/set/clima':
+		if action == 'set/clima':
 			logger.info('MQTT SET Clima > {}'.format(payload))
 			if verbose:
 				print('\nSET Klimatisierung',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/clima',switch_clima(car['vin'],payload))
 
-		if topic == mqtt_base_topic+car['topic']+'/set/climatemp':
+		if action == 'set/climatemp':
 			logger.info('MQTT SET Climatemp > {}'.format(payload))
 			if verbose:
 				print('\nSET Klimatisierung Soll-Temp.',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/climatemp',set_climatemp(car['vin'],payload))
 
-		if topic == mqtt_base_topic+car['topic']+'/set/window':
+		if action == 'set/window':
 			logger.info('MQTT SET Windowheater > {}'.format(payload))
 			if verbose:
 				print('\nSET Scheibenheizung',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/window',switch_window(car['vin'],payload))
 
-		if topic == mqtt_base_topic+car['topic']+'/set/charger':
+		if action == 'set/charger':
 			logger.info('MQTT SET Charger > {}'.format(payload))
 			if verbose:
 				print('\nSET Sofortladen',payload)
 			mclient.publish(mqtt_base_topic+car['topic']+'/response/charger',switch_charger(car['vin'],payload))
 
-		if topic == mqtt_base_topic+car['topic']+'/get/charger':
+		if action == 'get/charger':
 			if verbose:
 				print('\nGET Ladesystem',payload)
 			result = get_charger(car['vin'])
 			logger.info('MQTT GET Charger > {}'.format(result))
 
-		if topic == mqtt_base_topic+car['topic']+'/get/position':
+		if action == 'get/position':
 			if verbose:
 				print('\nGET Position')
 			result = get_position(car['vin'])
 			logger.info('MQTT GET Position > {}'.format(result))
 
-		if topic == mqtt_base_topic+car['topic']+'/get/clima':
+		if action == 'get/clima':
 			if verbose:
 				print('\nGET Klimatisierung')
 			result = get_clima(car['vin'])
 			logger.info('MQTT GET Clima > {}'.format(result))
 
-		if topic == mqtt_base_topic+car['topic']+'/get/state':
+		if action == 'get/state':
 			if verbose:
 				print('\nGET kurzer Status',payload)
 			result = get_carstate(car['vin'])
 			logger.info('MQTT GET Shortstate > {}'.format(result))
 
-		if topic == mqtt_base_topic+car['topic']+'/get/fullstate':
+		if action == 'get/fullstate':
 			if verbose:
 				print('\nGET langer Status',payload)
+			if payload == 'force':
+				car_snapshot_clear(car)
 			result = get_fullstate(car['vin'])
 			logger.info('MQTT GET Fullstate > {}'.format(result))
 
-	if topic == mqtt_base_topic+'get/state':
-		if verbose:
-			print('\nGET kurzer Status für alle Fahrzeuge',payload)
-		result = get_state()
-		logger.info('MQTT GET Shortstate > {}'.format(result))
-
-	if topic == mqtt_base_topic+'get/fullstate':
-		if verbose:
-			print('\nGET langer Status für alle Fahrzeuge',payload)
-		result = get_fullstate()
-		logger.info('MQTT GET Fullstate > {}'.format(result))
+	if action.startswith('get/'):
+		car_state_publish(car)
 
-	if topic == mqtt_base_topic+'set/service':
-		logger.info('MQTT SET Service > {}'.format(payload))
-		if verbose:
-			print('\nSET MQTT Service',payload)
-		mqtt_bridge = bool(state_conv(payload))
-		if not mqtt_brigde:
-			logger.warn('MQTT Service stopping - requested from MQTT!')
-		mclient.publish(mqtt_base_topic+'service/response',True)
+	if action.startswith('get/') or action in ('set/charger','set/clima'):
+		# next poll with the interval of the new charging/clima state
+		poller.reschedule(car['vin'])
 
 	if mconnect:
 		ts = datetime.now().strftime('%d.%m.%y %H:%M:%S')
@@ -265,9 +367,11 @@ def re_connect(client):
 		client.connect(mqtt_broker, mqtt_port)
 		mconnect = 1
 		client.publish(mqtt_base_topic+'active',1)
-		for car in cars:
+		build_routes()
+		for car in mycars:
 			if not car['active']: continue
 			client.subscribe([(mqtt_base_topic+car['topic']+'/set/#',0),(mqtt_base_topic+car['topic']+'/get/#',0)])
+		client.subscribe([(mqtt_base_topic+'get/#',0),(mqtt_base_topic+'set/service',0)])
 		logger.info('MQTT connected {}:{}'.format(mqtt_broker,mqtt_port))
 	except:
 		logger.error('MQTT disconnected - reconnect failed!')
@@ -278,12 +382,11 @@ def re_connect(client):
 def switch_clima(vin,state):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Clima failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Clima failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima','offline',1)
+			car_publish(car,'clima','offline',1,force=True)
 		result = False
 
 	newstate = state_string[state]
@@ -291,10 +394,11 @@ def switch_clima(vin,state):
 		r = vwc.climatisation(vin, action=newstate)
 		logger.debug('VWC SET Clima {} > {}'.format(newstate,r['action']['actionState']))
 		if r['action']['actionState'] == 'queued':
+			car['clima'] = newstate == 'on'
 			result = True
 	except:
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima','error',1)
+			car_publish(car,'clima','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -306,12 +410,11 @@ def switch_clima(vin,state):
 def switch_charger(vin,state):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Charger failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Charger failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger','offline',1)
+			car_publish(car,'charger','offline',1,force=True)
 		result = False
 
 	newstate = state_string[state]
@@ -319,10 +422,11 @@ def switch_charger(vin,state):
 		r = vwc.battery_charge(vin, action=newstate)
 		logger.debug('VWC SET Charger {} > {}'.format(newstate,r['action']['actionState']))
 		if r['action']['actionState'] == 'queued':
+			car['charging'] = newstate == 'on'
 			result =  True
 	except:
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger','error',1)
+			car_publish(car,'charger','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -334,12 +438,11 @@ def switch_charger(vin,state):
 def set_climatemp(vin,temp):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Charger failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Charger failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/temp','offline',1)
+			car_publish(car,'clima/temp','offline',1,force=True)
 		result = False
 
 	temp = float(temp)
@@ -352,7 +455,7 @@ def set_climatemp(vin,temp):
 				result =  True
 		except:
 			if mconnect:
-				mclient.publish(mqtt_base_topic+car['topic']+'/clima/temp','error',1)
+				car_publish(car,'clima/temp','error',1,force=True)
 			result = False
 	else:
 		logger.warn('VWC SET Climatemp failed - Temp out of range {}'.format(newtemp))
@@ -368,23 +471,22 @@ def set_climatemp(vin,temp):
 def do_flash(vin,duration=1):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Flash failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Flash failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/flash','offline',1)
+			car_publish(car,'flash','offline',1,force=True)
 		result = False
 
 	try:
 		r = vwc.flash(vin, car['lat'], car['lon'])
 		logger.debug('VWC SET Flash > {}'.format(r['action']['actionState']))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/flash','ok',1)
+			car_publish(car,'flash','ok',1,force=True)
 		result = True
 	except:
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/flash','error',1)
+			car_publish(car,'flash','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -397,23 +499,22 @@ def do_honk(vin,duration=1):
 	car = car_by('vin',vin)
 
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Honk failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Honk failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/honk','offline',1)
+			car_publish(car,'honk','offline',1,force=True)
 		result = False
 
 	try:
 		r = vwc.honk(vin, car['lat'], car['lon'], duration)
 		logger.debug('VWC SET Honk {} > {}'.format(duration,r['action']['actionState']))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/honk','ok',1)
+			car_publish(car,'honk','ok',1,force=True)
 		result = True
 	except:
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/honk','error',1)
+			car_publish(car,'honk','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -425,12 +526,11 @@ def do_honk(vin,duration=1):
 def switch_window(vin,state):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC SET Windowheater failed - Gateway offline {}'.format(result))
+		logger.warn('VWC SET Windowheater failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/windowheat','offline',1)
+			car_publish(car,'clima/windowheat','offline',1,force=True)
 		result = False
 
 	newstate = state_string[state]
@@ -441,7 +541,7 @@ def switch_window(vin,state):
 			result = True
 	except:
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/windowheat','error',1)
+			car_publish(car,'clima/windowheat','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -453,12 +553,11 @@ def switch_window(vin,state):
 def get_clima(vin):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC GET Clima failed - Gateway offline {}'.format(result))
+		logger.warn('VWC GET Clima failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima','offline',1)
+			car_publish(car,'clima','offline',1,force=True)
 		result = False
 
 	try:
@@ -466,12 +565,17 @@ def get_clima(vin):
 			print('\nKlimatisierungsdaten abrufen ...')
 
 		clima = vwc.get_climater(vin)
-		temp_target = round(clima['climater']['settings']['targetTemperature']['content']/10-273,1)
-		temp_outside = round(clima['climater']['status']['temperatureStatusData']['outdoorTemperature']['content']/10-273,1)
+		if telemetry:
+			telemetry.record_climater(vin, clima)
+		temp_target = dk_to_celsius(clima['climater']['settings']['targetTemperature']['content'])
+		temp_target_ts = clima['climater']['settings']['targetTemperature'].get('timestamp')
+		temp_outside = dk_to_celsius(clima['climater']['status']['temperatureStatusData']['outdoorTemperature']['content'])
+		temp_outside_ts = clima['climater']['status']['temperatureStatusData']['outdoorTemperature'].get('timestamp')
 		clima_state = clima['climater']['status']['climatisationStatusData']['climatisationState']['content']
 		clima_state_ts = clima['climater']['status']['climatisationStatusData']['climatisationState']['timestamp']
 		windowheat_state = clima['climater']['status']['windowHeatingStatusData']['windowHeatingStateRear']['content']
 		windowheat_state_ts = clima['climater']['status']['windowHeatingStatusData']['windowHeatingStateRear']['timestamp']
+		car['clima'] = clima_state != 'off'
 		logger.debug('CLIMATER state: {} @ {}'.format(clima_state,clima_state_ts))
 		logger.debug('CLIMATER temp_target: {}, temp_outside: {} @ {}'.format(temp_target,temp_outside,clima_state_ts))
 		logger.debug('CLIMATER windowheater: {} @ {}'.format(windowheat_state,windowheat_state_ts))
@@ -488,13 +592,13 @@ def get_clima(vin):
 			print('geparkt',parking)
 
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/temp/outside',temp_outside)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/temp/target',temp_target)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/state',clima_state)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/state/time',clima_state_ts)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/windowheat',windowheat_state)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/windowheat/time',windowheat_state_ts)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/parktime',parking)
+			car_publish(car,'clima/temp/outside',temp_outside,ts=temp_outside_ts)
+			car_publish(car,'clima/temp/target',temp_target,ts=temp_target_ts)
+			car_publish(car,'clima/state',clima_state,ts=clima_state_ts)
+			car_publish(car,'clima/state/time',clima_state_ts)
+			car_publish(car,'clima/windowheat',windowheat_state,ts=windowheat_state_ts)
+			car_publish(car,'clima/windowheat/time',windowheat_state_ts)
+			car_publish(car,'clima/parktime',parking)
 		result = True
 	except:
 		try:
@@ -503,7 +607,7 @@ def get_clima(vin):
 			strdata = 'empty'
 		logger.error('VWC GET Climastate failed - data not readable {}'.format(strdata))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima','error',1)
+			car_publish(car,'clima','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -516,12 +620,11 @@ def get_clima(vin):
 def get_charger(vin):
 	car = car_by('vin',vin)
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC GET Charger failed - Gateway offline {}'.format(result))
+		logger.warn('VWC GET Charger failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger','offline',1)
+			car_publish(car,'charger','offline',1,force=True)
 		result = False
 
 	try:
@@ -529,6 +632,8 @@ def get_charger(vin):
 			print('\nLadedaten abrufen ...')
 
 		charger = vwc.get_charger(vin)
+		if telemetry:
+			telemetry.record_charger(vin, charger)
 		# lademodus: off, conditioning,
 		charging_mode = charger['charger']['status']['chargingStatusData']['chargingMode']['content']
 		charging_mode_ts = charger['charger']['status']['chargingStatusData']['chargingMode']['timestamp']
@@ -536,6 +641,7 @@ def get_charger(vin):
 		charging_state_ts = charger['charger']['status']['chargingStatusData']['chargingState']['timestamp']
 		charging_time = charger['charger']['status']['batteryStatusData']['remainingChargingTime']['content']
 		charging_time_ts = charger['charger']['status']['batteryStatusData']['remainingChargingTime']['timestamp']
+		car['charging'] = charging_state == 'charging'
 		logger.debug('CHARGER mode: {} @ {}'.format(charging_mode,charging_mode_ts))
 		logger.debug('CHARGER state: {} @ {}'.format(charging_state,charging_state_ts))
 		logger.debug('CHARGER remain: {} @ {}'.format(charging_time,charging_time_ts))
@@ -566,16 +672,16 @@ def get_charger(vin):
 			print('Restladedauer',charging_time,'@',charging_time_ts)
 
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/active',state_conv(charging_state))
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/active/time',charging_state_ts)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/mode',charging_mode)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/range',driverange)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/level',level)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/estimated',charging_time)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/plug',state_conv(plug))
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/plug/time',plug_ts)
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/pluglock',state_conv(pluglock))
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/pluglock/time',pluglock_ts)
+			car_publish(car,'charger/active',state_conv(charging_state),ts=charging_state_ts)
+			car_publish(car,'charger/active/time',charging_state_ts)
+			car_publish(car,'charger/mode',charging_mode,ts=charging_mode_ts)
+			car_publish(car,'charger/range',driverange,ts=driverange_ts)
+			car_publish(car,'charger/level',level,ts=level_ts)
+			car_publish(car,'charger/estimated',charging_time,ts=charging_time_ts)
+			car_publish(car,'charger/plug',state_conv(plug),ts=plug_ts)
+			car_publish(car,'charger/plug/time',plug_ts)
+			car_publish(car,'charger/pluglock',state_conv(pluglock),ts=pluglock_ts)
+			car_publish(car,'charger/pluglock/time',pluglock_ts)
 		result = True
 	except:
 		try:
@@ -584,7 +690,7 @@ def get_charger(vin):
 			strdata = 'empty'
 		logger.error('VWC GET Charger failed - data not readable {}'.format(strdata))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger','error',1)
+			car_publish(car,'charger','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -595,16 +701,14 @@ def get_charger(vin):
 
 
 def get_position(vin):
-	global pos_lat,pos_lon
 	car = car_by('vin',vin)
 
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC GET Position failed - Gateway offline {}'.format(result))
+		logger.warn('VWC GET Position failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/position','offline',1)
+			car_publish(car,'position','offline',1,force=True)
 		result = False
 
 	try:
@@ -623,26 +727,25 @@ def get_position(vin):
 		logger.debug('POSITION latlon: {}, {} heading: {} @ {}'.format(lat,lon,pos_head,pos_time))
 
 		try:
-			data = requests.get('https://nominatim.openstreetmap.org/search.php?q='+str(lat)+','+str(lon)+'&polygon_geojson=1&format=jsonv2')
-			j = data.json()
-			if (len(j) > 0):
-				pos_name = j[0]['display_name']
-				logger.debug('POSITION nominatim: {}'.format(pos_name))
-		except:
-			logger.warn('OSM Nominatim failed - address not readable {}'.format(json.dumps(data)))
+			pos_name = geocoder.lookup(lat, lon)
+			logger.debug('POSITION nominatim: {}'.format(pos_name))
+		except Exception as e:
+			logger.warn('OSM Nominatim failed - address not readable {}'.format(e))
+			pos_name = None
+		if pos_name is None:
 			pos_name = 'unbekannt'
 
 		if verbose:
 			print('Position',str(lat)+', '+str(lon),'Richtung',pos_head,'\n ',pos_name)
 
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/latitude',pos_lat)
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/longitude',pos_lon)
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/latlon',str(lat)+','+str(lon))
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/heading',pos_head)
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/address',pos_name)
-			mclient.publish(mqtt_base_topic+car['topic']+'/position/time',pos_time)
-			mclient.publish(mqtt_base_topic+car['topic']+'/position','ok')
+			car_publish(car,'position/latitude',pos_lat,ts=pos_time)
+			car_publish(car,'position/longitude',pos_lon,ts=pos_time)
+			car_publish(car,'position/latlon',str(lat)+','+str(lon),ts=pos_time)
+			car_publish(car,'position/heading',pos_head,ts=pos_time)
+			car_publish(car,'position/address',pos_name,ts=pos_time)
+			car_publish(car,'position/time',pos_time)
+			car_publish(car,'position','ok',force=True)
 		
 		result = True
 	except:
@@ -652,7 +755,7 @@ def get_position(vin):
 			strdata = 'empty'
 		logger.error('VWC GET Position failed - data not readable {}'.format(strdata))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/position','error',1)
+			car_publish(car,'position','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -662,17 +765,16 @@ def get_position(vin):
 	return result
 
 
-def get_carstate(vin):
+def get_connect(vin):
 	car = car_by('vin',vin)
 
 	try:
-		vwc = WeConnect()
-		result = vwc.login()
+		vwc = vwc_client()
 	except:
-		logger.warn('VWC GET State failed - Gateway offline {}'.format(result))
+		logger.warn('VWC GET Connect failed - Gateway offline')
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/connect','offline',1)
-		result = False
+			car_publish(car,'connect','offline',1,force=True)
+		return False
 
 	try:
 		vehicle = vwc.get_vehicle_data(vin)
@@ -680,47 +782,61 @@ def get_carstate(vin):
 	except:
 		isConnect = 0
 	
-	mclient.publish(mqtt_base_topic+car['topic']+'/connect',isConnect,1)
+	if mconnect:
+		car_publish(car,'connect',isConnect,1)
 	logger.debug('STATE VIN {} connected {}'.format(vin,isConnect))
+	return True
+
+def get_carstate(vin, connect=True):
+	car = car_by('vin',vin)
+
+	if connect:
+		get_connect(vin)
+
+	try:
+		vwc = vwc_client()
+	except:
+		logger.warn('VWC GET State failed - Gateway offline')
+		if mconnect:
+			car_publish(car,'connect','offline',1,force=True)
+		result = False
 
 	try:
 		if verbose:
 			print('\nFahrzeugstatus abrufen ...')
 	
 		vsr = vwc.get_vsr(vin)
-		vsrdata = vwc.parse_vsr(vsr)
+		vsrdata = vwc.parse_vsr(vsr, typed=True)
+		if telemetry:
+			telemetry.record_vsr(vin, vsrdata)
 
-		doorlock = vsrdata['doors']['lock_left_front']
+		doorlock = vsrdata.get('doors','lock_left_front','null')
 		logger.debug('STATE door {}'.format(doorlock))
-		driverange = vsrdata['status']['primary_range']
+		driverange = vsrdata.get('status','primary_range','null')
 		logger.debug('STATE driverange {}'.format(driverange))
-		level = vsrdata['status']['state_of_charge']
+		level = vsrdata.get('status','state_of_charge','null')
 		logger.debug('STATE SoC {}'.format(level))
-		temp_outside = vsrdata['status']['temperature_outside']
+		temp_outside = vsrdata.get('status','temperature_outside','null')
 		logger.debug('STATE temp_outside {}'.format(temp_outside))
 
 		if verbose:
 			print('Fahrertür',doorlock,'Ladestand',level,'Reichweite',driverange,'Temp',temp_outside)
 
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/door/lock',doorlock,1)
-			driverange = driverange.replace(' km','')
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/range',driverange,1)
-			level = level.replace(' %','')
-			mclient.publish(mqtt_base_topic+car['topic']+'/charger/level',level,1)
-			temp_outside = temp_outside.replace(' dK','')
-			temp = round(int(temp_outside)/10-273,1)
-			mclient.publish(mqtt_base_topic+car['topic']+'/clima/temp/outside',temp,1)
+			car_publish(car,'door/lock',doorlock,1,ts=vsrdata.captured_at('doors','lock_left_front'))
+			car_publish(car,'charger/range',driverange,1,ts=vsrdata.captured_at('status','primary_range'))
+			car_publish(car,'charger/level',level,1,ts=vsrdata.captured_at('status','state_of_charge'))
+			car_publish(car,'clima/temp/outside',temp_outside,1,ts=vsrdata.captured_at('status','temperature_outside'))
 
 		result = True
 	except:
 		try:
-			strdata = json.dumps(vsrdata)
+			strdata = json.dumps(vsrdata.as_dict())
 		except:
 			strdata = 'empty'
 		logger.error('VWC GET State failed - vsr-data not readable {}'.format(strdata))
 		if mconnect:
-			mclient.publish(mqtt_base_topic+car['topic']+'/connect','error',1)
+			car_publish(car,'connect','error',1,force=True)
 		result = False
 
 	if verbose:
@@ -729,6 +845,22 @@ def get_carstate(vin):
 	logger.info('VWC GET State - Result {}'.format(result))
 	return result
 
+def get_vsrstate(vin):
+	return get_carstate(vin, connect=False)
+
+def limit_host(vin):
+	# one semaphore per home-region host (fal) of the car
+	host = urlparse(vwc_client().get_fal_url(vin)).netloc
+	with limit_lock:
+		if host not in limit_hosts:
+			limit_hosts[host] = threading.BoundedSemaphore(fullstate_limit_host)
+		return limit_hosts[host]
+
+def get_limited(func, vin):
+	with limit_host(vin):
+		with limit_account:
+			return func(vin)
+
 def get_state(vin=False):
 	car = car_by('vin',vin)
 	if car:
@@ -765,9 +897,15 @@ def get_fullstate(vin=False):
 	
 	result = True
 	activecar = False
+	jobs = {}
 	for car in cars:
 		if not car['active']: continue
 		activecar = True
+		if fullstate_concurrent:
+			logger.debug('GET Fullstate by starting all subroutines for {} ...'.format(car['name']))
+			for sub in (get_connect, get_vsrstate, get_clima, get_position, get_charger):
+				jobs[fullstate_pool.submit(get_limited, sub, car['vin'])] = (car['name'],sub.__name__)
+			continue
 		logger.debug('GET Fullstate by calling all subroutines for {} ...'.format(car['name']))
 		
 		if get_carstate(car['vin']) and get_clima(car['vin']) and get_position(car['vin']) and get_charger(car['vin']):
@@ -776,6 +914,18 @@ def get_fullstate(vin=False):
 		else:
 			logger.warn('GET Fullstate - least one subroutine failed')
 			result = False
+
+	# each subroutine publishes its own data as soon as it is finished
+	for job in as_completed(jobs):
+		try:
+			subresult = job.result()
+		except:
+			logger.exception('GET Fullstate - subroutine {} for {} crashed'.format(jobs[job][1],jobs[job][0]))
+			subresult = False
+		logger.debug('GET Fullstate - {} for {} > {}'.format(jobs[job][1],jobs[job][0],subresult))
+		if not subresult:
+			logger.warn('GET Fullstate - least one subroutine failed')
+			result = False
 	
 	if not activecar:
 		logger.warn('GET Fullstate - no active car in mycars')
@@ -791,38 +941,71 @@ def get_fullstate(vin=False):
 
 ## MQTT
 
-client_id = f'python-mqtt-{random.randint(0, 1000)}'
-logger.debug('MQTT connecting ... {}:{}'.format(mqtt_broker,mqtt_port))
-try:
-	if verbose:
-		print('Verbinde mit MQTT',mqtt_broker,mqtt_port)
-	mclient = mqtt.Client(client_id)
-	mclient.on_message = on_message
-	mclient.on_disconnect = on_disconnect
-	mclient.connect(mqtt_broker, mqtt_port)
-	mconnect = 1
-	mclient.publish(mqtt_base_topic+'active',1)
-	logger.info('MQTT connected @ {}:{}'.format(mqtt_broker,mqtt_port))
-except:
-	logger.error('MQTT connetion failed!')
-	mconnect = 0
-
-
-## WeConnect-Verbindung
-
-try:
-	result = False
-	vwc = WeConnect()
-	result = vwc.login()
-	logger.debug('VWC checking Gateway > login {}'.format(result))
-except:
-	logger.error('VWC checking Gateway > failed - Gateway seems offline {}'.format(result))
-	sys.exit(1)
+def service_alive():
+	# heartbeat of the service, the counters are read from the shared client without a login
+	mclient.publish(mqtt_base_topic+'service/active',1)
+	mclient.publish(mqtt_base_topic+'service/active/time',datetime.now().strftime('%H:%M:%S'))
+	if vwc is None:
+		return
+	for name, count in vwc.request_stats().items():
+		mclient.publish(mqtt_base_topic+'service/requests/'+name,count)
+	reuse = vwc.connection_stats()['reuse']
+	if reuse is not None:
+		mclient.publish(mqtt_base_topic+'service/requests/reuse',round(reuse,3))
+
+def metrics_publish():
+	# compact request metrics: per endpoint count, avg/max latency, status codes and bytes
+	if vwc is None:
+		return
+	m = vwc.request_metrics()
+	for e in m['endpoints'].values():
+		del e['buckets']
+	mclient.publish(mqtt_base_topic+'service/metrics',json.dumps(m))
+
+def mqtt_connect():
+	global mclient, mconnect
+	client_id = f'python-mqtt-{random.randint(0, 1000)}'
+	logger.debug('MQTT connecting ... {}:{}'.format(mqtt_broker,mqtt_port))
+	try:
+		if verbose:
+			print('Verbinde mit MQTT',mqtt_broker,mqtt_port)
+		mclient = mqtt.Client(client_id)
+		mclient.on_message = on_message
+		mclient.on_disconnect = on_disconnect
+		mclient.connect(mqtt_broker, mqtt_port)
+		mconnect = 1
+		mclient.publish(mqtt_base_topic+'active',1)
+		logger.info('MQTT connected @ {}:{}'.format(mqtt_broker,mqtt_port))
+	except:
+		logger.error('MQTT connetion failed!')
+		mconnect = 0
 
 
 ## MAIN
 
-if args['service']:
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='weconnectMQTT verbindet die VW WeConnect API mit einem MQTT-Broker und bietet ein kleines Shell-Interface')
+	parser.add_argument('--version', action='store_true',help='zeigt dies Versionsinfo')
+	parser.add_argument('--verbose', action='store_true',help='Ausgabe der Daten in lesbarer Form')
+	parser.add_argument('--info', action='store_true',help='Ausgabe von Meldungen aus dem internen Logger')
+	parser.add_argument('--debug', action='store_true',help='Ausgabe aller Meldungen aus dem internen Logger')
+	parser.add_argument('--profile', action='store_true',help='Anzeige WeConnect-Profildaten')
+	parser.add_argument('--state', action='store_true',help='Abruf kurzer Status *kann mit vin/plate/name kombiniert werden')
+	parser.add_argument('--fullstate', action='store_true',help='Abruf langer Status *kann mit vin/plate/name kombiniert werden')
+	parser.add_argument('--service', action='store_true',help='aktivieren der MQTT-Bridge als Service')
+	parser.add_argument('--vin', default=False,help='Auswahl des Fahrzeugs per FIN (XXX...123) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
+	parser.add_argument('--plate', default=False,help='Auswahl des Fahrzeugs per Kennzeichen (XXX-YY1234) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
+	parser.add_argument('--name', default=False,help='Auswahl des Fahrzeugs per Name (ABC) *für charger/clima/climatemp/window/honk/flash/state/fullstate')
+	parser.add_argument('--charger',help='schalte Ladung (1|0 oder on|off)')
+	parser.add_argument('--clima',help='schalte Klimatisierung (1|0 oder on|off)')
+	parser.add_argument('--climatemp',help='setze Solltemperatur in Grad-C (XX.X)')
+	parser.add_argument('--window',help='schalte Scheibenheizung (1|0 oder on|off)')
+	parser.add_argument('--honk',help='aktiviere Hupe (1|0 oder on|off)')
+	parser.add_argument('--flash',help='aktiviere Blinker (1|0 oder on|off)')
+	return vars(parser.parse_args(argv)), parser
+
+def run_service():
+	global lastrun, lastmetrics, lastsave, mqtt_bridge
 	logger.debug('SERVICE initialize ...')
 	if verbose:
 		print('\nMQTT Service ...')
@@ -834,20 +1017,37 @@ if args['service']:
 		logger.error('MQTT disconnected - MQTT Service failed!')
 		sys.exit(1)
 
+	if telemetry and telemetry_file:
+		telemetry.load(telemetry_file)
+		lastsave = time.time()
+
+	logger.debug('SERVICE start token refresher ...')
+	vwc_client().start_token_refresher()
+	vwc_client().prewarm()
+	if metrics_port:
+		vwc_client().start_metrics_server(metrics_port, metrics_host)
+
 	logger.debug('SERVICE register MQTT client  ...')
 	mclient.loop_start()
 	mclient.publish(mqtt_base_topic+'service/active',1)
 	logger.debug('SERVICE subscribe MQTT topics  ...')
 	
+	build_routes()
 	mqtt_subscribed = False
 	for car in mycars:
 		if not car['active']: continue
 		logger.debug('SERVICE subscribe {} for {}  ...'.format(mqtt_base_topic+car['topic'],car['name']))
 		mclient.subscribe([(mqtt_base_topic+car['topic']+'/set/#',0),(mqtt_base_topic+car['topic']+'/get/#',0)])
 		mqtt_subscribed = True
+	mclient.subscribe([(mqtt_base_topic+'get/#',0),(mqtt_base_topic+'set/service',0)])
 	
 	if mqtt_subscribed:
 		get_fullstate()
+		car_state_publish()
+		if poll_enabled:
+			for car in mycars:
+				if car['active']:
+					poller.add(car['vin'])
 	else:
 		logger.warn('SERVICE not car-topics subscribed - no active car in mycars')
 		if verbose:
@@ -860,9 +1060,28 @@ if args['service']:
 		while mqtt_bridge:
 			if time.time()-lastrun > mqtt_alive:
 				logger.debug('SERVICE is alive')
-				mclient.publish(mqtt_base_topic+'service/active',1)
-				mclient.publish(mqtt_base_topic+'service/active/time',datetime.now().strftime('%H:%M:%S'))
+				try:
+					service_alive()
+					if telemetry:
+						telemetry.compact()
+				except Exception:
+					logger.exception('SERVICE heartbeat failed')
 				lastrun = time.time()
+			if mqtt_metrics and time.time()-lastmetrics > mqtt_metrics:
+				try:
+					metrics_publish()
+				except Exception:
+					logger.exception('SERVICE metrics publish failed')
+				lastmetrics = time.time()
+			if telemetry and telemetry_file and time.time()-lastsave > telemetry_save:
+				try:
+					telemetry.save(telemetry_file)
+				except Exception:
+					logger.exception('SERVICE saving telemetry failed')
+				lastsave = time.time()
+			for vin in poller.due():
+				logger.debug('SERVICE poll {}'.format(vin))
+				dispatcher.submit(vin, handle_message, car_by('vin',vin), 'get/fullstate', '')
 			time.sleep(1)
 
 	except KeyboardInterrupt:
@@ -873,163 +1092,224 @@ if args['service']:
 
 	mclient.publish(mqtt_base_topic+'service/active',0)
 	mclient.publish(mqtt_base_topic+'service/active/offline',datetime.now().strftime('%H:%M:%S'))
+	dispatcher.shutdown(wait=False)
+	if telemetry and telemetry_file:
+		telemetry.save(telemetry_file)
 	time.sleep(2)
 	logger.debug('SERVICE clean exit')
 	sys.exit()
-	
-if args['vin'] or args['plate'] or args['name']:
-	if args['vin']:
-		car = car_by('vin',args['vin'])
-		logger.debug('CLI search car in mycars by vin {} > {}'.format(args['vin'],bool(car)))
-		if car and verbose:
-			print('Fahrzeug über VIN gefunden',car['name'])
-	elif args['plate']:
-		car = car_by('plate',args['plate'])
-		logger.debug('CLI search car in mycars by plate {} > {}'.format(args['plate'],bool(car)))
-		if car and verbose:
-			print('Fahrzeug über Kennzeichen gefunden',car['name'])
-	elif args['name']:
-		car = car_by('name',args['name'])
-		logger.debug('CLI search car in mycars by name {} > {}'.format(args['name'],bool(car)))
-		if car and verbose:
-			print('Fahrzeug über Name gefunden',car['name'])
-	if not car:
-		logger.error('CLI car not found in mycars {} {} {}'.format(args['vin'],args['plate'],args['name']))
+
+def run_cli(parser, argv):
+	if args['vin'] or args['plate'] or args['name']:
+		if args['vin']:
+			car = car_by('vin',args['vin'])
+			logger.debug('CLI search car in mycars by vin {} > {}'.format(args['vin'],bool(car)))
+			if car and verbose:
+				print('Fahrzeug über VIN gefunden',car['name'])
+		elif args['plate']:
+			car = car_by('plate',args['plate'])
+			logger.debug('CLI search car in mycars by plate {} > {}'.format(args['plate'],bool(car)))
+			if car and verbose:
+				print('Fahrzeug über Kennzeichen gefunden',car['name'])
+		elif args['name']:
+			car = car_by('name',args['name'])
+			logger.debug('CLI search car in mycars by name {} > {}'.format(args['name'],bool(car)))
+			if car and verbose:
+				print('Fahrzeug über Name gefunden',car['name'])
+		if not car:
+			logger.error('CLI car not found in mycars {} {} {}'.format(args['vin'],args['plate'],args['name']))
+			if verbose:
+				print('FEHLER: Fahrzeug nicht gefunden')
+			sys.exit(1)
+	else:
+		car = False
+		if len(mycars) == 1:
+			if mycars[0]['active']:
+				car = mycars[0]
+				logger.debug('only one car in mycars > selected {}'.format(car['name']))
+			else:
+				logger.warn('CLI only car in mycars not active - may cause problems')
+		elif not args['service'] and not args['state'] and not args['fullstate']:
+			logger.warn('CLI no car selected - may cause problems')
+
+	logger.debug('CLI parsing arguments ...')
+
+	if args['profile']:
+		try:
+			cars = vwc.get_real_car_data()
+			profile = vwc.get_personal_data()
+			mbb = vwc.get_mbb_status()
+
+			print('\nWeConnect-Profil')
+			print('Hallo {}!'.format(profile['nickname']))
+			print(' {}\n {} {}'.format(profile['salutation'], profile['firstName'], profile['lastName']))
+			print(' Profil vollständig?', mbb['profileCompleted'])
+			print(' S-PIN aktiviert?', mbb['spinDefined'])
+			print(' CarNet Länderkennung:',mbb['carnetEnrollmentCountry'])
+			if (cars and len(cars)):
+				print('bekannte Fahrzeuge')
+				for car in cars['realCars']:
+					vin = car['vehicleIdentificationNumber']
+					print('\tFIN:', vin,'\tKurzname:', car['nickname'])
+				get_carstate(vin)
+		except:
+			logger.error('VWC GET Profile failed - data not readable {}'.format(json.dumps(profile)))
+			if verbose:
+				print('FEHLER: WeConnect Profil konnte nicht abgerufen werden')
+
+	if args['state']:
 		if verbose:
-			print('FEHLER: Fahrzeug nicht gefunden')
-		sys.exit(1)
-else:
-	car = False
-	if len(mycars) == 1:
-		if mycars[0]['active']:
-			car = mycars[0]
-			logger.debug('only one car in mycars > selected {}'.format(car['name']))
+			print('\nkurzer Fahrzeugzustand ...')
+		if car:
+			get_state(car['vin'])
 		else:
-			logger.warn('CLI only car in mycars not active - may cause problems')
-	elif not args['service'] and not args['state'] and not args['fullstate']:
-		logger.warn('CLI no car selected - may cause problems')
+			get_state()
 
-logger.debug('CLI parsing arguments ...')
+	if args['fullstate']:
+		if verbose:
+			print('\nFahrzeugzustand ...')
+		if car:
+			get_fullstate(car['vin'])
+		else:
+			get_fullstate()
 
-if args['profile']:
-	try:
-		cars = vwc.get_real_car_data()
-		profile = vwc.get_personal_data()
-		mbb = vwc.get_mbb_status()
-
-		print('\nWeConnect-Profil')
-		print('Hallo {}!'.format(profile['nickname']))
-		print(' {}\n {} {}'.format(profile['salutation'], profile['firstName'], profile['lastName']))
-		print(' Profil vollständig?', mbb['profileCompleted'])
-		print(' S-PIN aktiviert?', mbb['spinDefined'])
-		print(' CarNet Länderkennung:',mbb['carnetEnrollmentCountry'])
-		if (cars and len(cars)):
-			print('bekannte Fahrzeuge')
-			for car in cars['realCars']:
-				vin = car['vehicleIdentificationNumber']
-				print('\tFIN:', vin,'\tKurzname:', car['nickname'])
-			get_carstate(vin)
-	except:
-		logger.error('VWC GET Profile failed - data not readable {}'.format(json.dumps(profile)))
+	if args['charger'] != None and car:
+		newstate = state_conv(args['charger'])
+		logger.info('CLI SET charger {} > {}'.format(newstate,car['name']))
 		if verbose:
-			print('FEHLER: WeConnect Profil konnte nicht abgerufen werden')
+			print('\nLadung schalten ...',newstate)
+		switch_charger(car['vin'],newstate)
+	elif args['charger'] != None:
+		logger.error('CLI SET charger failed - no car selected {}'.format(args['charger']))
+		if verbose:
+			print('\nFEHLER: Ladung schalten - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['state']:
-	if verbose:
-		print('\nkurzer Fahrzeugzustand ...')
-	if car:
-		get_state(car['vin'])
-	else:
-		get_state()
+	if args['clima'] != None and car:
+		newstate = state_conv(args['clima'])
+		logger.info('CLI SET clima {} > {}'.format(newstate,car['name']))
+		if verbose:
+			print('\nKlimatisierung schalten ...',newstate)
+		switch_clima(car['vin'],newstate)
+	elif args['clima'] != None:
+		logger.error('CLI SET clima failed - no car selected {}'.format(args['clima']))
+		if verbose:
+			print('\nFEHLER: Klimatisierung schalten - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['fullstate']:
-	if verbose:
-		print('\nFahrzeugzustand ...')
-	if car:
-		get_fullstate(car['vin'])
-	else:
-		get_fullstate()
+	if args['climatemp'] != None and car:
+		newtemp = state_conv(args['climatemp'])
+		logger.info('CLI SET climatemp {} > {}'.format(newtemp,car['name']))
+		if verbose:
+			print('\nKlimatisierungs Temp setzen ...',newtemp)
+		set_climatemp(car['vin'],newtemp)
+	elif args['climatemp'] != None:
+		logger.error('CLI SET climatemp failed - no car selected {}'.format(args['climatemp']))
+		if verbose:
+			print('\nFEHLER: Klimatisierung Temp setzen - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['charger'] != None and car:
-	newstate = state_conv(args['charger'])
-	logger.info('CLI SET charger {} > {}'.format(newstate,car['name']))
-	if verbose:
-		print('\nLadung schalten ...',newstate)
-	switch_charger(car['vin'],newstate)
-elif args['charger'] != None:
-	logger.error('CLI SET charger failed - no car selected {}'.format(args['charger']))
-	if verbose:
-		print('\nFEHLER: Ladung schalten - kein Fahrzeug gewählt')
-	sys.exit(1)
+	if args['window'] != None and car:
+		newstate = state_conv(args['window'])
+		logger.info('CLI SET windowheater {} > {}'.format(newstate,car['name']))
+		if verbose:
+			print('\nScheibenheizung schalten ...',newstate)
+		switch_window(car['vin'],newstate)
+	elif args['window'] != None:
+		logger.error('CLI SET windowheater failed - no car selected {}'.format(args['window']))
+		if verbose:
+			print('\nFEHLER: Scheibenheizung schalten - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['clima'] != None and car:
-	newstate = state_conv(args['clima'])
-	logger.info('CLI SET clima {} > {}'.format(newstate,car['name']))
-	if verbose:
-		print('\nKlimatisierung schalten ...',newstate)
-	switch_clima(car['vin'],newstate)
-elif args['clima'] != None:
-	logger.error('CLI SET clima failed - no car selected {}'.format(args['clima']))
-	if verbose:
-		print('\nFEHLER: Klimatisierung schalten - kein Fahrzeug gewählt')
-	sys.exit(1)
+	if args['honk'] != None and car:
+		newstate = state_conv(args['honk'])
+		logger.info('CLI SET honk {} > {}'.format(newstate,car['name']))
+		if verbose:
+			print('\nHupe aktivieren ...',newstate)
+		get_position(car['vin'])
+		do_honk(car['vin'],newstate)
+	elif args['honk'] != None:
+		logger.error('CLI SET honk failed - no car selected {}'.format(args['honk']))
+		if verbose:
+			print('\nFEHLER: Hupe aktivieren - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['climatemp'] != None and car:
-	newtemp = state_conv(args['climatemp'])
-	logger.info('CLI SET climatemp {} > {}'.format(newtemp,car['name']))
-	if verbose:
-		print('\nKlimatisierungs Temp setzen ...',newtemp)
-	set_climatemp(car['vin'],newtemp)
-elif args['climatemp'] != None:
-	logger.error('CLI SET climatemp failed - no car selected {}'.format(args['climatemp']))
-	if verbose:
-		print('\nFEHLER: Klimatisierung Temp setzen - kein Fahrzeug gewählt')
-	sys.exit(1)
+	if args['flash'] != None and car:
+		newstate = state_conv(args['flash'])
+		logger.info('CLI SET flash {} > {}'.format(newstate,car['name']))
+		if verbose:
+			print('\nBlinker aktivieren ...',newstate)
+		get_position(car['vin'])
+		do_flash(car['vin'],newstate)
+	elif args['flash'] != None:
+		logger.error('CLI SET honk failed - no car selected {}'.format(args['flash']))
+		if verbose:
+			print('\nFEHLER: Blinker aktivieren - kein Fahrzeug gewählt')
+		sys.exit(1)
 
-if args['window'] != None and car:
-	newstate = state_conv(args['window'])
-	logger.info('CLI SET windowheater {} > {}'.format(newstate,car['name']))
-	if verbose:
-		print('\nScheibenheizung schalten ...',newstate)
-	switch_window(car['vin'],newstate)
-elif args['window'] != None:
-	logger.error('CLI SET windowheater failed - no car selected {}'.format(args['window']))
-	if verbose:
-		print('\nFEHLER: Scheibenheizung schalten - kein Fahrzeug gewählt')
-	sys.exit(1)
+	if len(argv) == 0:
+		parser.print_help(sys.stderr)
 
-if args['honk'] != None and car:
-	newstate = state_conv(args['honk'])
-	logger.info('CLI SET honk {} > {}'.format(newstate,car['name']))
-	if verbose:
-		print('\nHupe aktivieren ...',newstate)
-	get_position(car['vin'])
-	do_honk(car['vin'],newstate)
-elif args['honk'] != None:
-	logger.error('CLI SET honk failed - no car selected {}'.format(args['honk']))
-	if verbose:
-		print('\nFEHLER: Hupe aktivieren - kein Fahrzeug gewählt')
-	sys.exit(1)
+	if mconnect:
+		mclient.publish(mqtt_base_topic+'active/time',datetime.now().strftime('%d.%m.%y %H:%M:%S'))
+		mclient.publish(mqtt_base_topic+'active',0)
 
-if args['flash'] != None and car:
-	newstate = state_conv(args['flash'])
-	logger.info('CLI SET flash {} > {}'.format(newstate,car['name']))
-	if verbose:
-		print('\nBlinker aktivieren ...',newstate)
-	get_position(car['vin'])
-	do_flash(car['vin'],newstate)
-elif args['flash'] != None:
-	logger.error('CLI SET honk failed - no car selected {}'.format(args['flash']))
-	if verbose:
-		print('\nFEHLER: Blinker aktivieren - kein Fahrzeug gewählt')
-	sys.exit(1)
+	logger.debug('CLI clean exit')
+	sys.exit()
 
-if len(sys.argv) == 1:
-	parser.print_help(sys.stderr)
+def main(argv=None):
+	global args, verbose, log_stream, log_level
+	argv = sys.argv[1:] if argv is None else argv
+	args, parser = parse_args(argv)
 
-if mconnect:
-	mclient.publish(mqtt_base_topic+'active/time',datetime.now().strftime('%d.%m.%y %H:%M:%S'))
-	mclient.publish(mqtt_base_topic+'active',0)
+	if args['verbose'] or args['debug'] or args['version']:
+		print('\nweconnectMQTT Version {}\n'.format(version))
+		if args['version']:
+			sys.exit()
+
+	if args['profile'] or args['fullstate'] or args['state'] or args['verbose']:
+		verbose = True
+		log_stream = True
+		log_level = cli_log_level
+
+	if args['service']:
+		log_stream = True
+		log_level = service_log_level
+
+	if args['info']:
+		log_stream = True
+		log_level = logging.INFO
+
+	if args['debug']:
+		log_stream = True
+		log_level = logging.DEBUG
+
+	logger.setLevel(log_level)
+	logger.propagate = False
+
+	logformat = logging.Formatter('%(asctime)s %(levelname)s\t%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+	console_log = logging.StreamHandler()
+	console_log.setFormatter(logformat)
+	console_log.setLevel(log_level)
+	logger.addHandler(console_log)
+
+	logger.debug('weconnectMQTT {} pre-initialized'.format(version))
+
+	build_runtime()
+	mqtt_connect()
+
+	try:
+		result = False
+		vwc_client()
+		result = True
+		logger.debug('VWC checking Gateway > login {}'.format(result))
+	except:
+		logger.error('VWC checking Gateway > failed - Gateway seems offline {}'.format(result))
+		sys.exit(1)
+
+	if args['service']:
+		run_service()
+	run_cli(parser, argv)
 
-logger.debug('CLI clean exit')
-sys.exit()
\ No newline at end of file
+if __name__ == '__main__':
+	main()